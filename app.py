@@ -1,44 +1,104 @@
 import os
+import time
 from scheduler import init_scheduler
-from flask import Flask, request, abort
-from linebot.v3 import WebhookHandler
-from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi,
-    ReplyMessageRequest, TextMessage
-)
+from flask import Flask, request, abort, jsonify, Response
+from linebot.v3.messaging import ReplyMessageRequest, PushMessageRequest, TextMessage
 from linebot.v3.webhooks import (
     MessageEvent, TextMessageContent, PostbackEvent, LocationMessageContent
 )
 from handlers import handle_user_message, handle_postback, handle_location_message
+import render_pool
+import cache
+import warmup
+import line_client
+import metrics
+import image_store
+import prerender
+from event_queue import AsyncWebhookHandler
 
 # ===== LOAD ENV =====
 # from dotenv import load_dotenv
 # load_dotenv()
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "")
 CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
+# reply token chỉ dùng được trong thời gian ngắn sau khi LINE gửi webhook;
+# xử lý lâu hơn ngưỡng này thì gửi push thay vì reply
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+# bấm lại cùng nút khi lần trước còn đang xử lý -> trả lời ngắn "đang xử lý" (0 = bỏ qua im lặng)
+TAP_ACK = os.getenv("TAP_ACK", "1") == "1"
+TAP_ACK_TEXT = "⏳ Yêu cầu của bạn đang được xử lý, vui lòng chờ trong giây lát!"
 
 print(f"[boot] SECRET set? {bool(CHANNEL_SECRET)} | TOKEN set? {bool(CHANNEL_ACCESS_TOKEN)}")
 
 # ===== APP / LINE =====
-app = Flask(__name__)
-handler = WebhookHandler(CHANNEL_SECRET)
-CFG = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
+# static/ do image_store phục vụ (ETag + Cache-Control immutable), không dùng static handler mặc định
+app = Flask(__name__, static_folder=None)
+# chạy sau nginx/apache có X-Sendfile -> để web server tự gửi file
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "0") == "1"
+# verify + trả 200 ngay, event xử lý ở worker thread; event trùng / bấm lặp bị bỏ (xem event_queue.py)
+handler = AsyncWebhookHandler(CHANNEL_SECRET)
+if not render_pool.is_worker_process():
+    # dựng sẵn process pool render ảnh báo cáo (không block request nhanh)
+    render_pool.start()
+    # nạp parquet + build index ở thread nền -> boot worker gần như tức thì
+    warmup.start()
+    # theo dõi file parquet: có bản mới thì đọc + build index nền rồi swap, không cần restart
+    cache.start_reloader()
+    # dọn ảnh báo cáo quá hạn / vượt dung lượng ở thread nền
+    image_store.start_sweeper()
+    # ghi lịch sử xem báo cáo + render trước báo cáo hay xem sau mỗi lần dữ liệu đổi
+    prerender.start()
+    # ghi metric của worker ra /dev/shm để /metrics (worker nào nhận scrape) trả tổng mọi worker
+    metrics.start_exporter()
+
+def _push_target(event) -> str | None:
+    """user/group/room gửi event (người nhận khi phải push thay reply)."""
+    src = getattr(event, "source", None)
+    return getattr(src, "user_id", None) or getattr(src, "group_id", None) or getattr(src, "room_id", None)
+
+def _reply_token_expired(event) -> bool:
+    ts = getattr(event, "timestamp", None)  # ms epoch lúc LINE tạo event
+    return bool(ts) and (time.time() - ts / 1000.0) > REPLY_TOKEN_TTL
+
+def push(event, messages):
+    to = _push_target(event)
+    if not to:
+        print("[push][ERROR] event không có user/group/room id -> bỏ")
+        return
+    try:
+        line_client.push_message(PushMessageRequest(to=to, messages=messages))
+        print(f"[push] OK to={to}")
+    except Exception as e:
+        print(f"[push][ERROR] {e}")
 
 def reply(event, messages):
     if not messages:
         messages = [TextMessage(text="(không có nội dung)")]
+    if _reply_token_expired(event):
+        print("[reply] replyToken quá hạn -> push")
+        metrics.inc("linebot_reply_fallback_total", help="Số lần phải push thay reply", reason="expired")
+        return push(event, messages)
     try:
-        with ApiClient(CFG) as c:
-            MessagingApi(c).reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=messages
-                )
+        line_client.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=messages
             )
+        )
         print("[reply] OK")
     except Exception as e:
-        # hay gặp nhất: invalid/expired replyToken (do redelivery hoặc reply trễ)
+        # hay gặp nhất: invalid/expired replyToken (do redelivery hoặc reply trễ) -> push
         print(f"[reply][ERROR] {e}")
+        if "reply token" in str(e).lower():
+            metrics.inc("linebot_reply_fallback_total", reason="invalid_token")
+            push(event, messages)
+
+def ack_busy(event):
+    """Trả lời bấm lặp (đã bị bỏ) bằng 1 dòng ngắn, không chạy lại báo cáo."""
+    reply(event, [TextMessage(text=TAP_ACK_TEXT)])
+
+if TAP_ACK:
+    handler.on_debounced = ack_busy
 
 def _is_redelivery(event) -> bool:
     """Bỏ qua redelivery để tránh reply lần 2 gây Invalid reply token."""
@@ -92,14 +152,39 @@ def callback():
         abort(400)
     return "OK"
 
+@app.get("/static/<path:filename>")
+def static_files(filename):
+    return image_store.send(filename)
+
 @app.get("/")
 def home():
     return "Bot is running", 200
 
 @app.get("/health")
 def health_check():
+    # live + ready + tiến độ nạp dữ liệu; 503 tới khi dữ liệu sẵn sàng
+    st = warmup.status()
+    return jsonify(st), (200 if st["ready"] else 503)
+
+metrics.gauge("linebot_ready", "1 khi warm-up dữ liệu xong", lambda: int(warmup.is_ready()))
+metrics.gauge("linebot_data_megabytes", "Bộ nhớ DataFrame đang cache theo file",
+              lambda: {(("dataset", os.path.basename(p)),): st["mb"] for p, st in cache.memory_report().items()})
+
+@app.get("/metrics")
+def metrics_endpoint():
+    # Prometheus text format; số liệu của worker (process) nhận request scrape
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/health/live")
+def health_live():
+    # process còn sống (không phụ thuộc dữ liệu)
     return "Bot is healthy", 200
 
+@app.get("/health/ready")
+def health_ready():
+    # chỉ 200 khi dữ liệu đã nạp xong -> chỉ nhận traffic khi warm
+    return ("ready", 200) if warmup.is_ready() else ("warming up", 503)
+
 if __name__ == "__main__":
     # khởi động lịch cố định
     SCHED = init_scheduler()
@@ -0,0 +1,80 @@
+# bench/bench_render.py
+"""
+So sánh các backend render bảng (renderer.RENDERERS): thời gian + RAM đỉnh theo số dòng.
+Mỗi phép đo chạy trong 1 process riêng để RAM đỉnh (ru_maxrss) không lẫn giữa các lần.
+
+Chạy từ thư mục gốc repo:
+    python bench/bench_render.py
+    python bench/bench_render.py --rows 10 50 200 1000 --repeat 3 --kind nhapban
+"""
+
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+NHAPBAN_COLS = ["Nhóm sản phẩm", "Nhu cầu", "PO", "Nhập", "Bán", "% Nhập/PO", "% Bán/Nhập", "Trạng thái"]
+NHUCAU_COLS = ["Tên sản phẩm", "Min chia", "Số chia", "Trạng thái"]
+
+def _sample_df(kind: str, rows: int):
+    import pandas as pd
+    if kind == "nhapban":
+        df = pd.read_parquet("data/data_nhapban.parquet", columns=NHAPBAN_COLS)
+        df = df.rename(columns={"Trạng thái": "Số chia hiện tại"})
+    else:
+        df = pd.read_parquet("data/data_nhucau.parquet", columns=NHUCAU_COLS)
+    return df.head(rows).reset_index(drop=True)
+
+def _max_rss_mb() -> float:
+    # Linux: KB, macOS: bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def _measure(backend: str, kind: str, df, repeat: int, out):
+    from renderer import render_table
+    rows = len(df)
+    title = f"Benchmark {kind} {rows} dòng\nNhóm hàng test\n(ngày cập nhật: 01-01-2025)"
+    outdir = tempfile.mkdtemp()
+    # warm-up: import pyplot / nạp font, không tính vào kết quả
+    render_table(kind, df.head(1), os.path.join(outdir, "warm.png"), title, backend=backend)
+    base = _max_rss_mb()
+    times = []
+    size = 0
+    for i in range(repeat):
+        path = os.path.join(outdir, f"out_{i}.png")
+        t0 = time.perf_counter()
+        render_table(kind, df, path, title, backend=backend)
+        times.append(time.perf_counter() - t0)
+        size = os.path.getsize(path)
+    out.put((min(times), sum(times) / len(times), _max_rss_mb() - base, size))
+
+def main():
+    from renderer import RENDERERS
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, nargs="+", default=[10, 50, 200, 1000])
+    ap.add_argument("--backends", nargs="+", default=list(RENDERERS))
+    ap.add_argument("--kind", choices=["nhucau", "nhapban"], default="nhapban")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    samples = {rows: _sample_df(args.kind, rows) for rows in args.rows}
+    ctx = mp.get_context("spawn")
+    print(f"kind={args.kind} repeat={args.repeat}")
+    print(f"{'backend':<12}{'rows':>7}{'best ms':>10}{'avg ms':>10}{'peak +MB':>10}{'png KB':>9}")
+    for rows in args.rows:
+        for backend in args.backends:
+            q = ctx.Queue()
+            # dữ liệu mẫu cắt sẵn ở process cha -> RAM process con không tính bảng parquet gốc
+            p = ctx.Process(target=_measure, args=(backend, args.kind, samples[rows], args.repeat, q))
+            p.start()
+            best, avg, peak, size = q.get()
+            p.join()
+            print(f"{backend:<12}{rows:>7}{best * 1000:>10.1f}{avg * 1000:>10.1f}{peak:>10.1f}{size / 1024:>9.0f}")
+
+if __name__ == "__main__":
+    main()
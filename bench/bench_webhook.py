@@ -0,0 +1,333 @@
+# bench/bench_webhook.py
+"""
+Load-test end-to-end cho webhook: bắn event LINE có chữ ký hợp lệ vào /callback với số luồng
+song song cố định, LINE API (reply/push/multicast) được thay bằng stub HTTP local.
+Mỗi loại event báo: throughput, latency ack (/callback trả 200) và latency end-to-end
+(gửi webhook -> stub nhận reply/push tương ứng) p50/p95/p99. Sau đó đo riêng vòng gửi tin theo lịch
+(scheduler._send_for_current_slot) với N người nhận giả.
+
+Chạy từ thư mục gốc repo (app chạy in-process qua Flask test client):
+    python bench/bench_webhook.py
+    python bench/bench_webhook.py --events 400 --concurrency 16 --mix text=1 category=2 report=2 location=1
+    python bench/bench_webhook.py --api-latency-ms 80 --sched-users 5000 --sched-messages 40
+
+Bắn vào server đang chạy (gunicorn...) thay vì in-process: chạy server với
+LINE_API_HOST=http://127.0.0.1:<stub-port> và LINE_CHANNEL_SECRET giống --secret, rồi
+    python bench/bench_webhook.py --url http://127.0.0.1:8080/callback --stub-port 8090
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import base64
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+import urllib.error
+import urllib.request
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+EVENT_TYPES = ("text", "category", "report", "location")
+
+# region LINE API stub
+class _Stub:
+    """Ghi lại thời điểm nhận từng request theo replyToken / người nhận để tính latency end-to-end."""
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000.0
+        self.lock = threading.Lock()
+        self.arrivals: dict[str, float] = {}   # replyToken hoặc userId -> perf_counter lúc nhận
+        self.counts: dict[str, int] = {}        # endpoint -> số request
+        self.recipients = 0                     # tổng người nhận push/multicast
+
+    def record(self, endpoint: str, body: dict) -> int:
+        now = time.perf_counter()
+        keys = [body["replyToken"]] if "replyToken" in body else []
+        to = body.get("to")
+        targets = to if isinstance(to, list) else ([to] if to else [])
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            self.recipients += len(targets) if endpoint != "reply" else 0
+            for k in keys + targets:
+                self.arrivals.setdefault(k, now)
+        return len(body.get("messages") or [])
+
+def _start_stub(latency_ms: float, port: int = 0):
+    stub = _Stub(latency_ms)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive như api.line.me
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]   # /v2/bot/message/reply -> reply
+            try:
+                n = stub.record(endpoint, json.loads(raw or b"{}"))
+            except ValueError:
+                n = 0
+            if stub.latency:
+                time.sleep(stub.latency)
+            out = {} if endpoint == "multicast" else {"sentMessages": [{"id": str(i), "quoteToken": "q"} for i in range(n)]}
+            data = json.dumps(out).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="line-stub", daemon=True).start()
+    return stub, server
+# endregion
+
+# region Webhook payload
+def _sign(secret: str, body: bytes) -> str:
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+def _event(kind: str, n: int, fixtures: dict, rng: random.Random) -> dict:
+    """1 event LINE; replyToken + userId riêng cho từng event để khớp với request stub nhận."""
+    base = {
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": f"Ubench{n:07d}"},
+        "webhookEventId": f"01BENCH{n:019d}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"bench-{kind}-{n}",
+    }
+    store = rng.choice(fixtures["stores"])
+    if kind == "text":
+        return {**base, "type": "message",
+                "message": {"id": str(n), "type": "text", "quoteToken": "q", "text": str(store)}}
+    if kind == "category":
+        cat = rng.choice(fixtures["cats"])
+        return {**base, "type": "postback", "postback": {"data": f"a=category.select&store={store}&cat={cat}"}}
+    if kind == "report":
+        cat = rng.choice(fixtures["cats"])
+        report = rng.choice(fixtures["reports"])
+        group = rng.choice(fixtures["groups"][cat])
+        data = f"a=report_group.select&store={store}&report={report}&group={group}&cat={cat}"
+        return {**base, "type": "postback", "postback": {"data": data}}
+    lat, lon = rng.choice(fixtures["coords"])
+    return {**base, "type": "message",
+            "message": {"id": str(n), "type": "location", "title": "bench", "address": "bench",
+                        "latitude": lat + rng.uniform(-0.01, 0.01), "longitude": lon + rng.uniform(-0.01, 0.01)}}
+
+def _fixtures(sample_stores: int, rng: random.Random) -> dict:
+    """Mã siêu thị / ngành / nhóm / toạ độ thật lấy từ dữ liệu để handler chạy đúng nhánh nóng."""
+    from config import NHU_CAU_PATH, CATEGORIES, REPORTS_DISPLAY
+    from handlers import get_lst_sieuthi
+    from utils import get_groups_for_category, get_store_locator
+    stores = sorted(get_lst_sieuthi())
+    cats = [c["id"] for c in CATEGORIES]
+    locator = get_store_locator()
+    return {
+        "stores": rng.sample(stores, min(sample_stores, len(stores))),
+        "cats": cats,
+        "reports": [r["id"] for r in REPORTS_DISPLAY],
+        "groups": {c: get_groups_for_category(NHU_CAU_PATH, c) for c in cats},
+        "coords": list(zip(locator.df["lat"].tolist(), locator.df["lon"].tolist())),
+    }
+# endregion
+
+# region Replay
+def _pct(values: list[float], q: float) -> float:
+    import numpy as np
+    return float(np.percentile(values, q)) * 1000 if values else float("nan")
+
+def _replay(events: list[tuple[str, dict]], secret: str, concurrency: int, url: str | None):
+    """Gửi từng event (1 event / request như LINE) -> [(kind, replyToken, userId, t_send, ack_s, status)]."""
+    if url is None:
+        from app import app
+        client_local = threading.local()
+
+    def post(item):
+        kind, ev = item
+        body = json.dumps({"destination": "Ubench", "events": [ev]}, ensure_ascii=False).encode()
+        headers = {"Content-Type": "application/json", "X-Line-Signature": _sign(secret, body)}
+        t0 = time.perf_counter()
+        if url is None:
+            client = getattr(client_local, "c", None) or app.test_client()
+            client_local.c = client
+            status = client.post("/callback", data=body, headers=headers).status_code
+        else:
+            req = urllib.request.Request(url, data=body, headers=headers, method="POST")
+            try:
+                with urllib.request.urlopen(req, timeout=30) as r:
+                    status = r.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+        return kind, ev["replyToken"], ev["source"]["userId"], t0, time.perf_counter() - t0, status
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as ex:
+        return list(ex.map(post, events))
+
+def _wait_replies(stub: _Stub, results, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with stub.lock:
+            pending = sum(1 for _, tok, uid, *_ in results if tok not in stub.arrivals and uid not in stub.arrivals)
+        if not pending:
+            return
+        time.sleep(0.05)
+
+def _report_events(stub: _Stub, results, wall: float) -> None:
+    print(f"\n== Webhook: {len(results)} event trong {wall:.2f}s ({len(results) / wall:.1f} event/s) ==")
+    print(f"{'event':<10}{'n':>6}{'ok':>6}{'lost':>6}{'ev/s':>8}"
+          f"{'ack p50':>10}{'p95':>8}{'p99':>8}{'e2e p50':>10}{'p95':>8}{'p99':>8}  (ms)")
+    for kind in EVENT_TYPES:
+        rows = [r for r in results if r[0] == kind]
+        if not rows:
+            continue
+        acks = [r[4] for r in rows if r[5] == 200]
+        e2e = []
+        for _, tok, uid, t0, _, status in rows:
+            t1 = stub.arrivals.get(tok) or stub.arrivals.get(uid)
+            if status == 200 and t1 is not None:
+                e2e.append(t1 - t0)
+        span = max(r[3] + r[4] for r in rows) - min(r[3] for r in rows)
+        print(f"{kind:<10}{len(rows):>6}{len(acks):>6}{len(acks) - len(e2e):>6}{len(rows) / max(span, 1e-9):>8.1f}"
+              f"{_pct(acks, 50):>10.1f}{_pct(acks, 95):>8.1f}{_pct(acks, 99):>8.1f}"
+              f"{_pct(e2e, 50):>10.1f}{_pct(e2e, 95):>8.1f}{_pct(e2e, 99):>8.1f}")
+    print(f"LINE stub: {dict(sorted(stub.counts.items()))}")
+# endregion
+
+# region Scheduler
+def _bench_scheduler(stub: _Stub, users: int, messages: int, workdir: str) -> None:
+    """Vòng gửi tin theo lịch với `users` người nhận, `messages` nội dung khác nhau, đều gửi hôm nay."""
+    import pandas as pd
+    import scheduler
+    today = datetime.now(scheduler.TZ).strftime("%d/%m/%Y")
+    df = pd.DataFrame({
+        "user_id": [f"U{i:032x}" for i in range(users)],  # đúng định dạng id LINE (scheduler bỏ id sai)
+        "ngay_gui_tin_nhan": today,
+        "noi_dung": [f"Bench nội dung #{i % max(messages, 1)}" for i in range(users)],
+    })
+    scheduler.XLSX_PATH = os.path.join(workdir, "schedule.xlsx")
+    scheduler.SCHEDULE_DB = os.path.join(workdir, "schedule.sqlite")
+    df.to_excel(scheduler.XLSX_PATH, index=False)
+
+    before = dict(stub.counts), stub.recipients
+    t0 = time.perf_counter()
+    scheduler._ensure_store()
+    t_import = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    rows = scheduler._read_rows_for_today()
+    t_query = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    stats = scheduler._send_for_current_slot() or {}
+    t_send = time.perf_counter() - t0
+    reqs = {k: v - before[0].get(k, 0) for k, v in stub.counts.items() if v - before[0].get(k, 0)}
+    return {"import": t_import, "query": t_query, "rows": len(rows), "send": t_send,
+            "stats": stats, "stub": reqs, "recipients": stub.recipients - before[1]}
+
+def _report_scheduler(res: dict, users: int, messages: int) -> None:
+    st = res["stats"]
+    print(f"\n== Scheduler: {users} người nhận, {messages} nội dung ==")
+    print(f"import xlsx -> sqlite: {res['import'] * 1000:.0f}ms | query hôm nay: {res['query'] * 1000:.1f}ms ({res['rows']} dòng)")
+    print(f"send loop: {res['send'] * 1000:.0f}ms | sent={st.get('sent')} failed={st.get('failed')} "
+          f"throttled={st.get('throttled')} requests={st.get('requests')} "
+          f"| stub nhận {res['stub']} ({res['recipients']} người nhận)")
+# endregion
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=200, help="tổng số event webhook")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--mix", nargs="+", default=["text=1", "category=1", "report=1", "location=1"],
+                    help="tỉ lệ loại event, vd. text=1 category=2 report=2 location=1")
+    ap.add_argument("--stores", type=int, default=50, help="số siêu thị ngẫu nhiên dùng trong payload")
+    ap.add_argument("--api-latency-ms", type=float, default=0.0, help="độ trễ giả lập của LINE API stub")
+    ap.add_argument("--stub-port", type=int, default=0)
+    ap.add_argument("--url", default=None, help="bắn vào server đang chạy thay vì app in-process")
+    ap.add_argument("--secret", default="bench-secret")
+    ap.add_argument("--reply-timeout", type=float, default=60.0, help="chờ reply tối đa (giây) sau khi bắn xong")
+    ap.add_argument("--sched-users", type=int, default=2000, help="0 = bỏ qua đo scheduler")
+    ap.add_argument("--sched-messages", type=int, default=20)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--verbose", action="store_true", help="giữ log của app")
+    args = ap.parse_args()
+    os.chdir(ROOT)
+
+    stub, server = _start_stub(args.api_latency_ms, args.stub_port)
+    stub_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"[bench] LINE API stub: {stub_url}")
+    # phải set trước khi import app / line_client
+    os.environ["LINE_API_HOST"] = stub_url
+    os.environ["LINE_CHANNEL_SECRET"] = args.secret
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench-token")
+    workdir = tempfile.mkdtemp(prefix="bench-webhook-")
+    os.environ.setdefault("SCHEDULE_XLSX", os.path.join(workdir, "schedule.xlsx"))
+    # ảnh báo cáo + lịch sử xem báo cáo của bench không ghi vào repo; tắt render trước
+    # (lượt render trước sau boot tranh CPU với render đang đo)
+    os.environ["IMAGE_DIR"] = os.path.join(workdir, "static")
+    os.environ["PRERENDER_DB"] = os.path.join(workdir, "report_history.sqlite")
+    os.environ["PRERENDER_TOP"] = "0"
+    # webhookEventId của bench lặp lại giữa các lần chạy -> trạng thái chống trùng riêng cho mỗi lần
+    os.environ["EVENT_STATE_DB"] = os.path.join(workdir, "events.sqlite")
+
+    weights = {k: float(v) for k, v in (m.split("=", 1) for m in args.mix)}
+    unknown = set(weights) - set(EVENT_TYPES)
+    if unknown:
+        ap.error(f"loại event không hỗ trợ: {sorted(unknown)} (có: {', '.join(EVENT_TYPES)})")
+    rng = random.Random(args.seed)
+
+    quiet = open(os.devnull, "w") if not args.verbose else None
+    with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+        t0 = time.perf_counter()
+        if args.url is None:
+            import app  # noqa: F401  boot: render pool + warm-up + reloader
+            import warmup
+            warmup.wait_ready(timeout=300)
+        t_boot = time.perf_counter() - t0
+        fixtures = _fixtures(args.stores, rng)
+        kinds = rng.choices(list(weights), weights=list(weights.values()), k=args.events)
+        events = [(k, _event(k, n, fixtures, rng)) for n, k in enumerate(kinds)]
+
+        t0 = time.perf_counter()
+        results = _replay(events, args.secret, args.concurrency, args.url)
+        _wait_replies(stub, results, args.reply_timeout)
+        wall = time.perf_counter() - t0
+
+    print(f"[bench] boot + warm-up: {t_boot:.2f}s")
+    _report_events(stub, results, wall)
+    if args.url is None:
+        import line_client
+        import metrics
+        import render_pool
+        print(f"line_client latency: {line_client.latency_stats()}")
+        print("\nStage (metrics.linebot_stage_seconds):")
+        for key, st in sorted(metrics.summary().items(), key=lambda kv: -kv[1]["count"] * kv[1]["avg_ms"]):
+            labels = " ".join(f"{k}={v}" for k, v in key)
+            print(f"  {labels:<60}{st['count']:>6}  avg {st['avg_ms']:>9.2f}ms")
+        render_pool.shutdown()
+
+    if args.sched_users > 0:
+        with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+            res = _bench_scheduler(stub, args.sched_users, args.sched_messages, workdir)
+        _report_scheduler(res, args.sched_users, args.sched_messages)
+
+    # dọn ảnh báo cáo, lịch, lịch sử do bench tạo
+    shutil.rmtree(workdir, ignore_errors=True)
+    server.shutdown()
+    if quiet:
+        quiet.close()
+    # render pool / event pool là thread nền của app -> thoát thẳng (flush trước, _exit không flush)
+    sys.stdout.flush()
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,414 @@
 # cache.py
 """
 Module quản lý cache cho DataFrame parquet.
-Chỉ đọc file 1 lần/instance, sau đó trả copy từ cache.
+Chỉ đọc file 1 lần cho mỗi phiên bản dữ liệu, sau đó trả view chỉ-đọc từ cache
+(không copy). Khi file parquet thay đổi (mtime/size) cache tự đọc lại.
+
+Mỗi phiên bản dữ liệu của 1 file là 1 snapshot: (version, DataFrame, các cấu trúc dẫn xuất).
+Có reloader chạy nền (start_reloader) thì file mới được đọc + build index ở thread nền rồi
+swap nguyên snapshot vào cache; request đang chạy vẫn dùng snapshot cũ tới khi xong.
+
+Mỗi file có thể khai báo schema (register_schema): chỉ đọc các cột cần dùng, cột chuỗi lặp lại
+nhiều (tên siêu thị, tên sản phẩm...) đọc dạng dictionary -> category, mã số nguyên ép về kiểu
+nhỏ nhất vừa đủ. Xem ước lượng bộ nhớ (so với đọc không khai báo schema) qua memory_report().
+
+File có schema còn được ghi 1 lần / version ra Arrow IPC trong DATA_SHARED_DIR (mặc định
+/dev/shm) rồi memory-map: các worker gunicorn dùng chung trang nhớ thay vì mỗi worker 1 bản.
 """
 
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
 import threading
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from metrics import stage
+
+try:
+    import fcntl  # khoá file giữa các worker (Linux); không có thì bỏ qua khoá
+except ImportError:
+    fcntl = None
+
+class _Snapshot:
+    """1 phiên bản dữ liệu của 1 file parquet + các cấu trúc dẫn xuất build từ chính nó."""
+    __slots__ = ("version", "df", "columns", "derived", "stats")
 
-# Lưu cache theo path
-_PARQUET_CACHE: dict[str, pd.DataFrame] = {}
+    def __init__(self, version: str, df: pd.DataFrame, columns: list[str] | None):
+        self.version = version
+        self.df = df
+        self.columns = columns
+        self.derived: dict[str, object] = {}
+        self.stats: dict = {}
+
+# Lưu cache theo path: {path: _Snapshot}
+_PARQUET_CACHE: dict[str, _Snapshot] = {}
+# Schema khai báo theo path: {path: {"columns", "categorical", "downcast"}}
+_SCHEMAS: dict[str, dict] = {}
+# Builder của các cấu trúc dẫn xuất (index, catalog...) theo (path, name), để reloader build trước
+_DERIVED_BUILDERS: dict[tuple[str, str], object] = {}
 # Khóa để tránh race condition khi nhiều request song song
 _PARQUET_LOCK = threading.RLock()
 
+# Reloader nền
+RELOAD_INTERVAL = float(os.getenv("DATA_RELOAD_INTERVAL", "30"))  # giây giữa 2 lần kiểm tra file
+RELOAD_SETTLE = float(os.getenv("DATA_RELOAD_SETTLE", "5"))       # file phải "đứng yên" bấy lâu mới đọc (tránh đọc file đang ghi)
+
+# Thư mục snapshot Arrow dùng chung giữa các worker gunicorn (chỉ file có schema); "" = tắt
+SHARED_DIR = os.getenv("DATA_SHARED_DIR", "/dev/shm/linebot-data" if os.path.isdir("/dev/shm") else "")
+_RELOADER: threading.Thread | None = None
+_RELOADER_STOP = threading.Event()
+# hàm gọi sau mỗi lần reloader swap version mới: fn(path, version)
+_RELOAD_LISTENERS: list = []
+
+def _file_version(path: str) -> str:
+    """
+    Phiên bản dữ liệu của file = mtime (ns) + size.
+    Đổi file (ghi đè / copy bản mới) -> version khác -> cache tự đọc lại.
+    """
+    st = os.stat(path)
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+def _freeze(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Khoá ghi các mảng bên dưới DataFrame để không ai sửa nhầm cache gốc.
+    Ghi vào view (df.loc[...] = ...) sẽ báo "assignment destination is read-only".
+    """
+    for blk in df._mgr.blocks:
+        # Chỉ khoá block numpy thường. Extension array (Int64, ...) của pandas 1.5
+        # không chạy được factorize/groupby trên buffer read-only nên để nguyên.
+        if isinstance(blk.values, np.ndarray):
+            blk.values.flags.writeable = False
+    return df
+
+def register_schema(path: str, columns: list[str] | None = None,
+                    categorical: list[str] = (), downcast: list[str] = ()) -> None:
+    """
+    Khai báo schema gọn cho 1 file parquet (áp dụng từ lần đọc kế tiếp).
+    Args:
+        path: đường dẫn file parquet
+        columns: chỉ đọc các cột này (None = tất cả)
+        categorical: cột chuỗi ít giá trị khác nhau -> đọc dạng dictionary, lưu category
+        downcast: cột mã số nguyên -> ép về int8/16/32 nhỏ nhất vừa đủ (giữ nullable nếu có)
+    """
+    with _PARQUET_LOCK:
+        _SCHEMAS[path] = {
+            "columns": list(columns) if columns else None,
+            "categorical": list(categorical),
+            "downcast": list(downcast),
+        }
+
+def _strings_nbytes(s: pd.Series) -> int:
+    # pyarrow to_pandas dùng chung 1 object cho các chuỗi trùng nhau: 1 con trỏ / dòng + mỗi giá trị khác nhau 1 lần
+    return len(s) * 8 + sum(sys.getsizeof(v) for v in pd.unique(s.dropna()))
+
+def _column_nbytes(s: pd.Series) -> int:
+    """Bộ nhớ thật của cột (memory_usage(deep=True) đếm 1 object chuỗi / dòng, quá lên với dữ liệu từ pyarrow)."""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        cats = s.cat.categories
+        return s.cat.codes.nbytes + len(cats) * 8 + sum(sys.getsizeof(v) for v in cats)
+    if s.dtype == object:
+        return _strings_nbytes(s)
+    return int(s.memory_usage(index=False, deep=False))
+
+def _object_nbytes(s: pd.Series) -> int:
+    """Ước lượng bộ nhớ của cột nếu đọc không khai báo schema (chuỗi object / int64), để so sánh."""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return len(s) * 8 + sum(sys.getsizeof(v) for v in s.cat.categories)
+    if s.dtype == object:
+        return _strings_nbytes(s)
+    if pd.api.types.is_integer_dtype(s.dtype):
+        return len(s) * (9 if pd.api.types.is_extension_array_dtype(s.dtype) else 8)
+    return int(s.memory_usage(index=False, deep=False))
+
+def _apply_schema(path: str, df: pd.DataFrame, schema: dict) -> dict:
+    """Ép kiểu theo schema (tại chỗ) + trả thống kê bộ nhớ trước/sau."""
+    for col in schema["categorical"]:
+        if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype):
+            # category từ dictionary của parquet giữ thứ tự xuất hiện; sắp lại theo chữ cái
+            # để sort_values trên cột category cho cùng thứ tự như cột chuỗi.
+            df[col] = df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+    for col in schema["downcast"]:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    total = len(pq.read_schema(path).names)
+    nbytes = sum(_column_nbytes(df[c]) for c in df.columns)
+    before = sum(_object_nbytes(df[c]) for c in df.columns)
+    return {
+        "rows": len(df),
+        "columns": f"{len(df.columns)}/{total}",
+        "mb": round(nbytes / 1e6, 1),
+        "mb_uncompacted": round(before / 1e6, 1),
+        "saved_pct": round(100 * (1 - nbytes / before), 1) if before else 0.0,
+    }
+
+def _read_compact(path: str, columns: list[str] | None, schema: dict) -> tuple[pd.DataFrame, dict]:
+    cols = columns or schema["columns"]
+    # read_dictionary: pyarrow giữ chuỗi dạng dictionary -> pandas category, không tạo
+    # từng object str cho mỗi dòng (đỡ cả bộ nhớ đỉnh lúc đọc).
+    dict_cols = [c for c in schema["categorical"] if cols is None or c in cols]
+    df = pd.read_parquet(path, columns=cols, read_dictionary=dict_cols or None)
+    stats = _apply_schema(path, df, schema)
+    print(f"[CACHE] {path}: {stats['rows']} dòng, {stats['columns']} cột, ~{stats['mb']}MB "
+          f"(ước lượng, đọc không khai báo schema: ~{stats['mb_uncompacted']}MB)")
+    return df, stats
+
+# region Shared snapshot (Arrow IPC memory-map)
+def _shared_file(path: str, version: str, columns: list[str] | None, schema: dict) -> str:
+    """File Arrow của (path, version, schema): mọi worker cùng cấu hình ra cùng 1 tên file."""
+    key = json.dumps([os.path.abspath(path), version, columns, schema], sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(SHARED_DIR, f"{stem}.{digest}.arrow")
+
+def _write_arrow(df: pd.DataFrame, out: str, stats: dict) -> None:
+    """Ghi DataFrame gọn ra Arrow IPC (ghi file tạm rồi os.replace -> worker khác không đọc file dở)."""
+    tbl = pa.Table.from_pandas(df, preserve_index=False)
+    for i, name in enumerate(tbl.column_names):
+        if pd.api.types.is_float_dtype(df[name].dtype):
+            # giữ NaN là giá trị float (from_pandas đổi NaN -> null) để lúc map đọc zero-copy
+            tbl = tbl.set_column(i, name, pa.array(df[name].to_numpy(), from_pandas=False))
+    meta = dict(tbl.schema.metadata or {})
+    meta[b"cache_stats"] = json.dumps(stats).encode("utf-8")
+    tbl = tbl.replace_schema_metadata(meta)
+    tmp = f"{out}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp, "wb") as f, pa.ipc.new_file(f, tbl.schema) as writer:
+        writer.write_table(tbl)
+    os.replace(tmp, out)
+
+def _map_arrow(file: str) -> tuple[pd.DataFrame, dict]:
+    """
+    Map file Arrow vào DataFrame: cột số + mã category trỏ thẳng vào trang của file
+    (read-only, dùng chung page cache giữa các process), chỉ cột nullable Int nhỏ bị copy.
+    """
+    tbl = pa.ipc.open_file(pa.memory_map(file, "r")).read_all()
+    stats = json.loads((tbl.schema.metadata or {}).get(b"cache_stats", b"{}"))
+    # split_blocks: mỗi cột 1 block, không gộp block (gộp = copy)
+    return tbl.to_pandas(split_blocks=True), stats
+
+def _purge_shared(path: str, keep: str) -> None:
+    """Xoá file Arrow của version cũ; worker đang map vẫn đọc được tới khi nhả (unlink trên Linux)."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    for old in glob.glob(os.path.join(glob.escape(SHARED_DIR), f"{glob.escape(stem)}.*.arrow*")):
+        if old.startswith(keep):
+            continue
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+def _read_shared(path: str, version: str, columns: list[str] | None, schema: dict) -> tuple[pd.DataFrame, dict]:
+    """
+    Worker đầu tiên gặp version mới đọc parquet + ghi Arrow (giữ file lock trong lúc ghi),
+    các worker khác chờ lock rồi chỉ map file -> N worker tốn ~1 bản dữ liệu trong RAM.
+    """
+    file = _shared_file(path, version, columns, schema)
+    if not os.path.exists(file):
+        os.makedirs(SHARED_DIR, exist_ok=True)
+        with open(f"{file}.lock", "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(file):
+                df, stats = _read_compact(path, columns, schema)
+                _write_arrow(df, file, {**stats, "shared": file})
+                _purge_shared(path, keep=file)
+                print(f"[CACHE] Ghi snapshot dùng chung {file} ({os.path.getsize(file) / 1e6:.1f}MB)")
+    df, stats = _map_arrow(file)
+    print(f"[CACHE] Map snapshot dùng chung {file}")
+    return df, stats
+
+def _read_snapshot(path: str, version: str, columns: list[str] | None) -> _Snapshot:
+    schema = _SCHEMAS.get(path)
+    if schema is None:
+        df = pd.read_parquet(path, columns=columns) if columns else pd.read_parquet(path)
+        return _Snapshot(version, _freeze(df), columns)
+
+    df = stats = None
+    if SHARED_DIR:
+        try:
+            df, stats = _read_shared(path, version, columns, schema)
+        except Exception as e:
+            # /dev/shm đầy / không ghi được -> giữ bản riêng trong process như trước
+            print(f"[CACHE][shared][ERROR] {path}: {e} -> đọc riêng")
+    if df is None:
+        df, stats = _read_compact(path, columns, schema)
+    snap = _Snapshot(version, _freeze(df), columns)
+    snap.stats = stats
+    return snap
+# endregion
+
+def _reloader_running() -> bool:
+    return _RELOADER is not None and _RELOADER.is_alive()
+
+def _load_snapshot(path: str, columns: list[str] | None = None) -> _Snapshot:
+    """
+    Trả snapshot hiện hành của path.
+    - Reloader đang chạy: trả ngay snapshot đang có (file mới do thread nền lo), không stat file.
+    - Không có reloader: stat file, đổi version thì đọc lại ngay trong request (như cũ).
+    """
+    snap = _PARQUET_CACHE.get(path)
+    if snap is not None and _reloader_running():
+        return snap
+    version = _file_version(path)
+    if snap is not None and snap.version == version:
+        return snap
+    with _PARQUET_LOCK:
+        snap = _PARQUET_CACHE.get(path)
+        if snap is None or snap.version != version:
+            if snap is None:
+                print(f"[CACHE] Đang đọc file {path} lần đầu...")
+            else:
+                print(f"[CACHE] File {path} đã thay đổi ({snap.version} -> {version}), đọc lại...")
+            with stage("data_read", dataset=os.path.basename(path)):
+                snap = _read_snapshot(path, version, columns)
+            _PARQUET_CACHE[path] = snap
+        return snap
+
 def load_df_once(path: str, columns: list[str] | None = None) -> pd.DataFrame:
     """
-    Đọc parquet lần đầu tiên, các lần sau trả bản copy từ cache.
+    Đọc parquet lần đầu tiên, các lần sau trả view chỉ-đọc từ cache (không copy dữ liệu).
     Args:
         path: đường dẫn file parquet
         columns: danh sách cột cần đọc (tuỳ chọn)
     Returns:
-        DataFrame (copy, không đụng cache gốc)
+        DataFrame dùng chung dữ liệu với cache. Lọc/chọn cột/rename/thêm cột trên
+        kết quả thoải mái (tạo object mới), nhưng KHÔNG ghi đè giá trị tại chỗ được.
+    """
+    df = _load_snapshot(path, columns).df
+    # shallow copy: chỉ tạo object DataFrame mới, dùng chung mảng dữ liệu.
+    # Thêm/xoá/đổi tên cột trên kết quả không ảnh hưởng cache gốc.
+    return df.copy(deep=False)
+
+def data_version(path: str) -> str:
+    """
+    Version hiện hành của dữ liệu (đổi khi file parquet đổi).
+    Dùng làm khoá cho các cache phụ thuộc dữ liệu (index, ảnh, flex...).
+    """
+    return _load_snapshot(path).version
+
+def load_derived(path: str, name: str, builder):
+    """
+    Trả cấu trúc dẫn xuất từ DataFrame của path (index, catalog...), build 1 lần / version.
+    Args:
+        path: đường dẫn file parquet
+        name: tên cấu trúc (khoá cache, mỗi loại 1 tên)
+        builder: hàm builder(df) -> object, nhận DataFrame chỉ-đọc của đúng version đó
+    Returns:
+        object do builder tạo ra; tự build lại khi file parquet đổi version.
+        Reloader build sẵn cho version mới trước khi swap nên request không phải chờ.
+    """
+    return load_derived_versioned(path, name, builder)[1]
+
+def load_derived_versioned(path: str, name: str, builder) -> tuple[str, object]:
+    """
+    Như load_derived nhưng trả kèm version của đúng snapshot đã build ra object: (version, object).
+    Dùng khi khoá cache theo version phải khớp với dữ liệu (gọi data_version riêng có thể đã là version
+    khác nếu reloader swap giữa 2 lần gọi).
+    """
+    snap = _load_snapshot(path)
+    obj = snap.derived.get(name)
+    if obj is not None:
+        return snap.version, obj
+    with _PARQUET_LOCK:
+        _DERIVED_BUILDERS[(path, name)] = builder
+        obj = snap.derived.get(name)
+        if obj is None:
+            print(f"[CACHE] Build {name} cho {path} (version {snap.version})...")
+            with stage("index_build", index=name):
+                obj = builder(snap.df)
+            snap.derived[name] = obj
+        return snap.version, obj
+
+def memory_report() -> dict:
+    """
+    Ước lượng bộ nhớ dữ liệu từng file đang cache: {path: {version, rows, columns, mb, mb_uncompacted, saved_pct}}
+    (mb_uncompacted: cùng cách tính cho các cột đó nếu đọc không khai báo schema; không phải số đo RSS).
+    """
+    with _PARQUET_LOCK:
+        snaps = dict(_PARQUET_CACHE)
+    report = {}
+    for path, snap in snaps.items():
+        if not snap.stats:
+            # file không khai báo schema: đo 1 lần / snapshot (tốn thời gian với cột object)
+            snap.stats = {
+                "rows": len(snap.df),
+                "columns": str(len(snap.df.columns)),
+                "mb": round(sum(_column_nbytes(snap.df[c]) for c in snap.df.columns) / 1e6, 1),
+            }
+        report[path] = {"version": snap.version, **snap.stats}
+    return report
+
+# region Hot reload
+def reload_path(path: str, force: bool = False) -> bool:
+    """
+    Đọc version mới của path (nếu có) + build các cấu trúc dẫn xuất đã đăng ký, rồi swap snapshot.
+    Chạy ngoài lock: request vẫn đọc snapshot cũ trong lúc đọc file mới.
+    Returns:
+        True nếu đã swap snapshot mới.
     """
+    old = _PARQUET_CACHE.get(path)
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        print(f"[CACHE][reload] không stat được {path}: {e}")
+        return False
+    version = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+    if old is not None and old.version == version and not force:
+        return False
+    if not force and time.time() - st.st_mtime < RELOAD_SETTLE:
+        return False  # file có thể đang được ghi, lần kiểm tra sau đọc
+
+    t0 = time.monotonic()
+    try:
+        with stage("data_reload", dataset=os.path.basename(path)):
+            snap = _read_snapshot(path, version, old.columns if old else None)
+            builders = {name: b for (p, name), b in list(_DERIVED_BUILDERS.items()) if p == path}
+            for name, builder in builders.items():
+                snap.derived[name] = builder(snap.df)
+    except Exception as e:
+        # file hỏng / ghi dở -> giữ snapshot cũ, lần sau thử lại
+        print(f"[CACHE][reload][ERROR] {path}: {e}")
+        return False
+    with _PARQUET_LOCK:
+        _PARQUET_CACHE[path] = snap
+    print(f"[CACHE][reload] {path}: {old.version if old else None} -> {version} "
+          f"({len(snap.df)} dòng, {len(builders)} index) trong {time.monotonic() - t0:.2f}s")
+    for fn in list(_RELOAD_LISTENERS):
+        try:
+            fn(path, version)
+        except Exception as e:
+            print(f"[CACHE][reload][ERROR] listener {getattr(fn, '__name__', fn)}: {e}")
+    return True
+
+def on_reload(fn) -> None:
+    """Đăng ký fn(path, version), gọi (ở thread reloader) mỗi khi 1 file được swap sang version mới."""
     with _PARQUET_LOCK:
-        if path not in _PARQUET_CACHE:
-            print(f"[CACHE] Đang đọc file {path} lần đầu...")
-            df = pd.read_parquet(path, columns=columns) if columns else pd.read_parquet(path)
-            _PARQUET_CACHE[path] = df
-        # Luôn trả bản copy để tránh modify nhầm cache gốc
-        return _PARQUET_CACHE[path].copy()
+        if fn not in _RELOAD_LISTENERS:
+            _RELOAD_LISTENERS.append(fn)
+
+def _reload_loop(interval: float) -> None:
+    while not _RELOADER_STOP.wait(interval):
+        for path in list(_PARQUET_CACHE):
+            reload_path(path)
+
+def start_reloader(interval: float = RELOAD_INTERVAL) -> None:
+    """Bật thread nền theo dõi các file đã cache, có version mới thì đọc + swap snapshot."""
+    global _RELOADER
+    with _PARQUET_LOCK:
+        if _reloader_running():
+            return
+        _RELOADER_STOP.clear()
+        _RELOADER = threading.Thread(target=_reload_loop, args=(interval,), name="data-reloader", daemon=True)
+        _RELOADER.start()
+    print(f"[CACHE] reloader started (interval={interval}s, settle={RELOAD_SETTLE}s)")
+
+def stop_reloader() -> None:
+    _RELOADER_STOP.set()
+# endregion
 
 def clear_cache(path: str | None = None) -> None:
     """
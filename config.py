@@ -1,10 +1,33 @@
 import os
 from report import report_thongtinchiahang, report_ketquabanhang
+from cache import register_schema
 
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://finer-mantis-allowed.ngrok-free.app")
 NHU_CAU_PATH = os.getenv("NHU_CAU_PATH", f"data/data_nhucau.parquet")
 NHAP_BAN_PATH = os.getenv("NHAP_BAN_PATH", f"data/data_nhapban.parquet")
 
+# ===== SCHEMA DỮ LIỆU CACHE =====
+# Chỉ đọc các cột báo cáo/menu dùng tới; chuỗi lặp nhiều -> category; mã số -> int nhỏ nhất vừa đủ.
+# Thêm cột mới vào báo cáo thì nhớ khai báo ở đây.
+DATA_SCHEMAS = {
+    NHU_CAU_PATH: {
+        "columns": ["Mã siêu thị", "Tên siêu thị", "Mã ngành hàng", "Mã nhóm hàng", "Nhóm hàng",
+                    "Tên sản phẩm", "Min chia", "Số chia", "Trạng thái", "Ngày cập nhật"],
+        "categorical": ["Tên siêu thị", "Nhóm hàng", "Tên sản phẩm", "Trạng thái", "Ngày cập nhật"],
+        "downcast": ["Mã siêu thị", "Mã ngành hàng", "Mã nhóm hàng"],
+    },
+    NHAP_BAN_PATH: {
+        "columns": ["Mã siêu thị", "Tên siêu thị", "Mã ngành hàng", "Mã nhóm hàng", "Nhóm sản phẩm",
+                    "Nhu cầu", "PO", "Nhập", "Bán", "% Nhập/PO", "% Bán/Nhập", "Trạng thái",
+                    "Từ ngày", "Đến ngày"],
+        "categorical": ["Tên siêu thị", "Nhóm sản phẩm", "% Nhập/PO", "% Bán/Nhập", "Trạng thái",
+                        "Từ ngày", "Đến ngày"],
+        "downcast": ["Mã siêu thị", "Mã ngành hàng", "Mã nhóm hàng"],
+    },
+}
+for _path, _schema in DATA_SCHEMAS.items():
+    register_schema(_path, **_schema)
+
 # ===== CẤU HÌNH HIỂN THỊ BÁO CÁO =====
 REPORTS_DISPLAY = [
     {"id": "thongtinchiahang", "title": "Thông tin chia hàng", "decription": "Số lượng chia mỗi ngày theo sản phẩm."},
@@ -0,0 +1,313 @@
+# event_queue.py
+"""
+Xử lý webhook bất đồng bộ.
+/callback chỉ verify chữ ký + parse rồi đẩy event vào thread pool và trả 200 ngay;
+handler (lọc dữ liệu, render ảnh, reply) chạy ở worker thread.
+Event trùng bị bỏ trước khi vào hàng đợi:
+- cùng webhookEventId đã nhận trong EVENT_DEDUP_TTL giây (LINE gửi lại, retry mạng...);
+- cùng (người dùng, postback data) trong lúc lần bấm trước còn đang xử lý hoặc mới xong chưa
+  quá TAP_DEBOUNCE giây (bấm liên tục khi báo cáo đang render) -> on_debounced(event) nếu có
+  (vd. trả "đang xử lý").
+Trạng thái chống trùng dùng chung giữa các worker gunicorn: SQLite trong EVENT_STATE_DB (mặc định
+/dev/shm), kiểm tra + ghi trong 1 transaction. EVENT_STATE_DB="" -> chỉ trong process (TTLCache).
+"""
+
+import os
+import time
+import sqlite3
+import inspect
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from linebot.v3 import WebhookHandler
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, PostbackEvent
+from metrics import stage, observe, inc, STAGE_SECONDS
+
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "4"))
+# tối đa số event đang chờ + đang xử lý; đầy thì xử lý ngay trong request (không bỏ event)
+EVENT_QUEUE = int(os.getenv("EVENT_QUEUE", "200"))
+EVENT_DEDUP_TTL = float(os.getenv("EVENT_DEDUP_TTL", "600"))   # giây nhớ webhookEventId đã nhận
+TAP_DEBOUNCE = float(os.getenv("TAP_DEBOUNCE", "3"))           # giây bỏ bấm lặp sau khi lần trước xong
+TAP_INFLIGHT_TTL = 120.0                                       # chặn trên nếu lần bấm trước không bao giờ xong
+DEDUP_MAXSIZE = int(os.getenv("DEDUP_MAXSIZE", "10000"))
+EVENT_STATE_DB = os.getenv("EVENT_STATE_DB", "/dev/shm/linebot-events.sqlite" if os.path.isdir("/dev/shm") else "")
+
+class TTLCache:
+    """
+    Dict có hạn: mỗi khoá hết hạn sau ttl giây, tối đa maxsize khoá (đầy thì bỏ khoá cũ nhất).
+    add() là thao tác kiểm tra + thêm nguyên tử (2 thread cùng khoá: chỉ 1 thread thêm được).
+    """
+    def __init__(self, maxsize: int = DEDUP_MAXSIZE):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()  # key -> (hết hạn lúc, value)
+        self._lock = threading.Lock()
+
+    def _get(self, key, now: float):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._data[key]
+            return None
+        return entry[1]
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.monotonic())
+
+    def add(self, key, value, ttl: float):
+        """Thêm key nếu chưa có (hoặc đã hết hạn). Returns: value đang có của key, None nếu vừa thêm."""
+        now = time.monotonic()
+        with self._lock:
+            old = self._get(key, now)
+            if old is not None:
+                return old
+            self._data[key] = (now + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return None
+
+    def touch(self, key, ttl: float) -> None:
+        """Đặt lại hạn của key còn sống thành ttl giây kể từ bây giờ."""
+        now = time.monotonic()
+        with self._lock:
+            value = self._get(key, now)
+            if value is not None:
+                self._data[key] = (now + ttl, value)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class _MemoryState:
+    """Trạng thái chống trùng trong process (không có thư mục dùng chung)."""
+    def __init__(self):
+        self._events = TTLCache()
+        self._taps = TTLCache()  # tap key -> {"busy": còn đang xử lý, "acked": đã báo "đang xử lý"}
+        self._lock = threading.Lock()
+
+    def seen_event(self, event_id: str) -> bool:
+        return self._events.add(event_id, True, EVENT_DEDUP_TTL) is not None
+
+    def begin_tap(self, key: str) -> tuple[bool, bool, bool]:
+        with self._lock:
+            prev = self._taps.add(key, {"busy": True, "acked": False}, TAP_INFLIGHT_TTL)
+            if prev is None:
+                return True, False, False
+            ack = prev["busy"] and not prev["acked"]
+            if ack:
+                prev["acked"] = True
+            return False, prev["busy"], ack
+
+    def end_tap(self, key: str) -> None:
+        with self._lock:
+            state = self._taps.get(key)
+            if state is not None:
+                state["busy"] = False
+            self._taps.touch(key, TAP_DEBOUNCE)
+
+class _SharedState:
+    """
+    Trạng thái chống trùng dùng chung giữa các process: 1 file SQLite (tmpfs), mỗi thao tác kiểm tra + ghi
+    là 1 transaction BEGIN IMMEDIATE (khoá ghi của SQLite = khoá giữa các worker). Thời gian theo đồng hồ
+    hệ thống (time.time) vì so sánh giữa các process.
+    """
+    PURGE_EVERY = 500  # số thao tác giữa 2 lần xoá khoá hết hạn
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._ops = 0
+        with self._connect() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS seen_events (key TEXT PRIMARY KEY, expires REAL NOT NULL)")
+            con.execute("CREATE TABLE IF NOT EXISTS taps (key TEXT PRIMARY KEY, expires REAL NOT NULL, "
+                        "busy INTEGER NOT NULL, acked INTEGER NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            # isolation_level=None: tự quản transaction (BEGIN IMMEDIATE) để kiểm tra + ghi nguyên tử
+            con = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=OFF")  # tmpfs, mất khi reboot cũng không sao
+            self._local.con = con
+        return con
+
+    def _txn(self, fn):
+        con = self._connect()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            out = fn(con, time.time())
+            self._ops += 1
+            if self._ops % self.PURGE_EVERY == 0:
+                now = time.time()
+                con.execute("DELETE FROM seen_events WHERE expires < ?", (now,))
+                con.execute("DELETE FROM taps WHERE expires < ?", (now,))
+            con.execute("COMMIT")
+            return out
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+    def seen_event(self, event_id: str) -> bool:
+        def fn(con, now):
+            row = con.execute("SELECT expires FROM seen_events WHERE key = ?", (event_id,)).fetchone()
+            if row is not None and row[0] > now:
+                return True
+            con.execute("INSERT OR REPLACE INTO seen_events (key, expires) VALUES (?, ?)",
+                        (event_id, now + EVENT_DEDUP_TTL))
+            return False
+        return self._txn(fn)
+
+    def begin_tap(self, key: str) -> tuple[bool, bool, bool]:
+        def fn(con, now):
+            row = con.execute("SELECT expires, busy, acked FROM taps WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] <= now:
+                con.execute("INSERT OR REPLACE INTO taps (key, expires, busy, acked) VALUES (?, ?, 1, 0)",
+                            (key, now + TAP_INFLIGHT_TTL))
+                return True, False, False
+            busy, ack = bool(row[1]), bool(row[1]) and not row[2]
+            if ack:
+                con.execute("UPDATE taps SET acked = 1 WHERE key = ?", (key,))
+            return False, busy, ack
+        return self._txn(fn)
+
+    def end_tap(self, key: str) -> None:
+        def fn(con, now):
+            con.execute("UPDATE taps SET busy = 0, expires = ? WHERE key = ?", (now + TAP_DEBOUNCE, key))
+        self._txn(fn)
+
+def _event_state():
+    if EVENT_STATE_DB:
+        try:
+            return _SharedState(EVENT_STATE_DB)
+        except sqlite3.Error as e:
+            print(f"[event-queue][ERROR] {EVENT_STATE_DB}: {e} -> chống trùng chỉ trong process")
+    return _MemoryState()
+
+def _tap_key(event):
+    """(người gửi, postback data) của PostbackEvent (ghép thành 1 chuỗi), None với event khác."""
+    if not isinstance(event, PostbackEvent):
+        return None
+    src = getattr(event, "source", None)
+    sender = getattr(src, "user_id", None) or getattr(src, "group_id", None) or getattr(src, "room_id", None)
+    data = getattr(getattr(event, "postback", None), "data", None)
+    return f"{sender}\x1f{data}" if sender and data else None
+
+class AsyncWebhookHandler(WebhookHandler):
+    """
+    WebhookHandler dùng y như bản gốc (@handler.add(...)), nhưng handle() không chờ handler chạy xong.
+    """
+    def __init__(self, channel_secret, workers: int = EVENT_WORKERS, queue_size: int = EVENT_QUEUE,
+                 on_debounced=None):
+        super().__init__(channel_secret)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="event")
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._state = _event_state()
+        # on_debounced(event): gọi (ở worker thread) tối đa 1 lần / lượt xử lý khi có bấm lặp lúc đang bận
+        self.on_debounced = on_debounced
+
+    def _accept(self, event):
+        """
+        Lọc event trùng. Returns: (nhận?, tap key) - tap key != None thì phải gọi _tap_done sau khi xử lý.
+        Lỗi đọc / ghi trạng thái chung -> vẫn nhận event (thà xử lý trùng còn hơn bỏ sót).
+        """
+        event_id = getattr(event, "webhook_event_id", None)
+        key = _tap_key(event)
+        try:
+            if event_id and self._state.seen_event(event_id):
+                print(f"[event-queue] duplicate webhookEventId={event_id} -> bỏ")
+                inc("linebot_events_dropped_total", help="Số event bị bỏ vì trùng", reason="duplicate_event")
+                return False, None
+            if key is None:
+                return True, None
+            accepted, busy, ack = self._state.begin_tap(key)
+        except sqlite3.Error as e:
+            print(f"[event-queue][ERROR] event state: {e}")
+            return True, None
+        if accepted:
+            return True, key
+        print(f"[event-queue] debounce tap {key!r} (busy={busy})")
+        inc("linebot_events_dropped_total", help="Số event bị bỏ vì trùng", reason="debounced_tap")
+        if ack and self.on_debounced is not None:
+            self._pool.submit(self._safe, self.on_debounced, event)
+        return False, None
+
+    def _tap_done(self, key) -> None:
+        """Lần bấm đã xử lý xong: bấm lặp thêm TAP_DEBOUNCE giây nữa vẫn bị bỏ, sau đó xử lý như mới."""
+        try:
+            self._state.end_tap(key)
+        except sqlite3.Error as e:
+            print(f"[event-queue][ERROR] event state: {e}")
+
+    @staticmethod
+    def _safe(fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"[event-queue][ERROR] {getattr(fn, '__name__', fn)}: {e}")
+
+    def handle(self, body, signature):
+        """
+        Verify chữ ký + parse (lỗi -> raise như bản gốc), rồi đưa từng event vào hàng đợi.
+        """
+        with stage("verify") as st:
+            if not self.parser.signature_validator.validate(body, signature):
+                st.outcome = "invalid"
+                raise InvalidSignatureError("Invalid signature. signature=" + signature)
+        with stage("parse"):
+            # parse() verify lại chữ ký 1 lần nữa (HMAC body nhỏ, không đáng kể)
+            payload = self.parser.parse(body, signature, as_payload=True)
+        for event in payload.events:
+            accepted, tap = self._accept(event)
+            if not accepted:
+                continue
+            if self._slots.acquire(blocking=False):
+                self._pool.submit(self._run, event, time.perf_counter(), tap, payload.destination)
+            else:
+                print("[event-queue] queue full -> xử lý đồng bộ")
+                inc("linebot_event_queue_full_total", help="Số event xử lý đồng bộ vì hàng đợi đầy")
+                try:
+                    self._dispatch(event, payload.destination)
+                finally:
+                    if tap is not None:
+                        self._tap_done(tap)
+
+    def _run(self, event, queued_at: float, tap=None, destination=None):
+        observe(STAGE_SECONDS, time.perf_counter() - queued_at, stage="queue_wait", outcome="ok")
+        try:
+            self._dispatch(event, destination)
+        except Exception as e:
+            print(f"[event-queue][ERROR] {type(event).__name__}: {e}")
+        finally:
+            if tap is not None:
+                self._tap_done(tap)
+            self._slots.release()
+
+    @staticmethod
+    def _invoke(func, event, destination) -> None:
+        # như WebhookHandler.__invoke_func: handler nhận (event, destination), (event) hoặc ()
+        spec = inspect.getfullargspec(func)
+        if spec.varargs is not None or len(spec.args) == 2:
+            func(event, destination)
+        elif len(spec.args) == 1:
+            func(event)
+        else:
+            func()
+
+    def _dispatch(self, event, destination=None):
+        # cùng quy tắc chọn handler với WebhookHandler.handle: (event, message) -> event -> default
+        func = None
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(f"{type(event).__name__}_{type(event.message).__name__}")
+        if func is None:
+            func = self._handlers.get(type(event).__name__, self._default)
+        if func is None:
+            print(f"[event-queue] no handler for {type(event).__name__}")
+            return
+        kind = type(event).__name__
+        if isinstance(event, MessageEvent):
+            kind = f"{kind}_{type(event.message).__name__}"
+        with stage("dispatch", event=kind):
+            self._invoke(func, event, destination)
@@ -1,17 +1,57 @@
-import pandas as pd
+import os
 from urllib.parse import parse_qs
 # LINE SDK v3
 from linebot.v3.messaging import TextMessage, FlexMessage
 from linebot.v3.messaging.models import FlexContainer
 
-from cache import load_df_once
-from utils import build_flex_categories, build_flex_report_group, nearest_stores, build_flex_text_message, get_groups_for_category
-from config import PUBLIC_BASE_URL, NHU_CAU_PATH, NHAP_BAN_PATH, REPORTS_DISPLAY, DATA_PATH_FOR_REPORT, REPORT_HANDLERS, CATEGORIES
+from cache import data_version
+import warmup
+import prerender
+import metrics
+from metrics import stage
+from utils import build_flex_categories, build_flex_report_group, nearest_stores, build_flex_text_message, get_catalog, FlexCache
+from config import PUBLIC_BASE_URL, NHU_CAU_PATH, REPORTS_DISPLAY, DATA_PATH_FOR_REPORT, REPORT_HANDLERS, CATEGORIES
+
+# dữ liệu được nạp nền lúc boot (warmup.py), không đọc parquet lúc import
+WARMING_UP_TEXT = "⏳ Hệ thống đang khởi động, vui lòng thử lại sau giây lát!"
+
+# menu nhóm hàng chỉ hiện các nhóm siêu thị đang chọn có dữ liệu (0 = mọi nhóm của ngành như cũ)
+MENU_STORE_GROUPS = os.getenv("MENU_STORE_GROUPS", "0") == "1"
 
-df_nhap_ban = load_df_once(NHAP_BAN_PATH)
 #====== DỮ LIỆU SIÊU THỊ ======
-df_sieuthi = load_df_once(NHU_CAU_PATH)
-lst_sieuthi = df_sieuthi['Mã siêu thị'].unique().tolist()
+def get_lst_sieuthi() -> frozenset:
+    """Tập mã siêu thị của version dữ liệu hiện hành (tự cập nhật khi reload), tra `in` O(1)."""
+    return get_catalog(NHU_CAU_PATH).stores
+
+# ====== CACHE FLEX MENU ======
+# menu chỉ phụ thuộc (store, cat, version dữ liệu) -> build + validate 1 lần rồi dùng lại
+FLEX_CACHE = FlexCache(maxsize=int(os.getenv("FLEX_CACHE_SIZE", "512")))
+metrics.gauge("linebot_flex_cache_lookups", "Số lần tra FLEX_CACHE theo kết quả (hit/miss)",
+              lambda: {(("result", "hit"),): FLEX_CACHE.hits, (("result", "miss"),): FLEX_CACHE.misses})
+
+def _build_category_message(store_id: int) -> FlexMessage:
+    with stage("flex", menu="categories"):
+        cat_flex = build_flex_categories(store_id, CATEGORIES, include_display_text=False)
+        return FlexMessage(altText="Chọn ngành hàng", contents=FlexContainer.from_dict(cat_flex))
+
+def _build_report_group_message(store_id: int, cat_id: int) -> FlexMessage:
+    # =========== NHÓM HÀNG ==================
+    with stage("filter", menu="report_group"):
+        VALID_GROUPS = get_catalog(NHU_CAU_PATH).groups(cat_id, store_id=store_id if MENU_STORE_GROUPS else None)
+
+    # Build Flex "chọn báo cáo & nhóm hàng" (dùng cùng groups cho mọi report)
+    with stage("flex", menu="report_group"):
+        groups_by_report = {r["id"]: VALID_GROUPS for r in REPORTS_DISPLAY}
+        grp_flex = build_flex_report_group(
+            store_id=store_id,
+            reports=REPORTS_DISPLAY,
+            groups_by_report=groups_by_report,
+            groups_per_bubble=7,
+            include_display_text=False,   # không đẩy displayText vào khung chat
+            cat_id=cat_id                 # giữ cat_id để truyền qua postback
+        )
+        return FlexMessage(altText="Chọn báo cáo & nhóm hàng",
+                           contents=FlexContainer.from_dict(grp_flex))
 
 # ====== XỬ LÝ TEXT ======
 def handle_user_message(user_text: str, user_id: str = None):
@@ -29,15 +69,16 @@ def handle_user_message(user_text: str, user_id: str = None):
         return [build_flex_text_message(text, bg="#038d38", fg="#FFFFFF", header_fg="#FFFFFF",
                                         size="md", weight="regular", header_text="💡Hướng dẫn")]
     # ---------- (2) NUMBER = MÃ SIÊU THỊ ----------
+    if not warmup.wait_ready():
+        return [TextMessage(text=WARMING_UP_TEXT)]
     store_id = int(user_text)
-    if store_id not in lst_sieuthi:
+    if store_id not in get_lst_sieuthi():
         text = "[Mã siêu thị] không tồn tại!\nVui lòng kiểm tra lại!"
         return [build_flex_text_message(text, bg="#761414", fg="#FFFFFF", header_fg="#FFFFFF",
                                         size="md", weight="regular", header_text="⚠️ Cảnh báo")]
 
     # Flex: CHỌN NGÀNH HÀNG (4 nút)
-    cat_flex = build_flex_categories(store_id, CATEGORIES, include_display_text=False)
-    return [FlexMessage(altText="Chọn ngành hàng", contents=FlexContainer.from_dict(cat_flex))]
+    return [FLEX_CACHE.get_or_build(("categories", store_id), lambda: _build_category_message(store_id))]
 
 def handle_postback(data: str):
     """
@@ -47,26 +88,17 @@ def handle_postback(data: str):
     qs = parse_qs(data or "")
     action = (qs.get("a", [""])[0])
 
+    if action in ("category.select", "report_group.select") and not warmup.wait_ready():
+        return [TextMessage(text=WARMING_UP_TEXT)]
+
     # ===== BƯỚC 2: USER CHỌN NGÀNH =====
     if action == "category.select":
         store_id = int(qs.get("store", ["0"])[0] or 0)
         cat_id   = int(qs.get("cat",   ["0"])[0] or 0)
 
-        # =========== NHÓM HÀNG ==================
-        VALID_GROUPS = get_groups_for_category(NHU_CAU_PATH, cat_id)
-
-        # Build Flex "chọn báo cáo & nhóm hàng" (dùng cùng groups cho mọi report)
-        groups_by_report = {r["id"]: VALID_GROUPS for r in REPORTS_DISPLAY}
-        grp_flex = build_flex_report_group(
-            store_id=store_id,
-            reports=REPORTS_DISPLAY,
-            groups_by_report=groups_by_report,
-            groups_per_bubble=7,
-            include_display_text=False,   # không đẩy displayText vào khung chat
-            cat_id=cat_id                 # giữ cat_id để truyền qua postback
-        )
-        return [FlexMessage(altText="Chọn báo cáo & nhóm hàng",
-                            contents=FlexContainer.from_dict(grp_flex))]
+        return [FLEX_CACHE.get_or_build(("report_group", store_id, cat_id),
+                                        lambda: _build_report_group_message(store_id, cat_id),
+                                        version=data_version(NHU_CAU_PATH))]
 
     # ===== BƯỚC 3: USER CHỌN NHÓM TRONG 1 BÁO CÁO =====
     if action == "report_group.select":
@@ -84,12 +116,14 @@ def handle_postback(data: str):
         if report in REPORT_HANDLERS:
             handler_func = REPORT_HANDLERS[report]
             data_path = DATA_PATH_FOR_REPORT[report]
-            messages.extend(handler_func(data_path=data_path,
-                                         public_base_url=PUBLIC_BASE_URL,
-                                         store_id=int(store),
-                                         cat_id=cat_id,
-                                         cat_name=cat_name,
-                                         group=group))
+            prerender.record(report, store, cat_id, group)
+            with stage("report", report=report):
+                messages.extend(handler_func(data_path=data_path,
+                                             public_base_url=PUBLIC_BASE_URL,
+                                             store_id=int(store),
+                                             cat_id=cat_id,
+                                             cat_name=cat_name,
+                                             group=group))
         else:
             messages.append(TextMessage(text=f"⚠️ Chưa có handler cho báo cáo: {report}"))
 
@@ -102,8 +136,11 @@ def handle_location_message(lat: float, lon: float):
     """
     Nhận vị trí người dùng -> tìm siêu thị gần nhất -> trả thông báo + Flex chọn ngành hàng.
     """
+    if not warmup.wait_ready():
+        return [TextMessage(text=WARMING_UP_TEXT)]
     try:
-        df = nearest_stores(lat, lon, k=1, max_km=30)
+        with stage("locate"):
+            df = nearest_stores(lat, lon, k=1, max_km=30)
     except Exception:
         return [TextMessage(text="⚠️ Không đọc được dữ liệu vị trí. Vui lòng thử lại sau.")]
 
@@ -0,0 +1,187 @@
+# image_store.py
+"""
+Kho ảnh báo cáo trong IMAGE_DIR (mặc định static/) có giới hạn; URL luôn là /static/<tên file> (url_path).
+- Ảnh do report tạo có tên theo nội dung: table_{report}_{store}_{digest}.png (xem report._image_path),
+  các trang sau table_..._{digest}_p2.png... (page_path), mỗi trang kèm ảnh thu nhỏ *_preview.png
+  (preview_path) -> nội dung không bao giờ đổi, phục vụ với ETag = digest + hậu tố trang / preview, Cache-Control immutable.
+- Thread nền (start_sweeper) định kỳ xoá ảnh quá TTL (tính từ lần dùng gần nhất, touch() khi
+  cache hit) và xoá ảnh cũ nhất khi tổng dung lượng vượt IMAGE_STORE_MAX_MB.
+  Các file cùng digest (trang + preview của 1 báo cáo) được giữ / xoá cùng nhau.
+  Ảnh mới hơn IMAGE_MIN_AGE không bao giờ bị xoá (LINE có thể chưa tải về).
+- Dọn luôn file tạm *.tmp.png do render bị kill giữa chừng.
+File khác (không đúng mẫu tên trên) không bị đụng tới, và vẫn được phục vụ từ static/.
+"""
+
+import os
+import re
+import time
+import threading
+from flask import send_from_directory
+
+import metrics
+
+IMAGE_DIR = os.getenv("IMAGE_DIR", "static")                         # thư mục ghi ảnh, phục vụ qua URL /static/<tên file>
+IMAGE_STORE_MAX_MB = float(os.getenv("IMAGE_STORE_MAX_MB", "500"))
+IMAGE_TTL = float(os.getenv("IMAGE_TTL_HOURS", "48")) * 3600        # giây, tính từ lần dùng gần nhất
+IMAGE_MIN_AGE = float(os.getenv("IMAGE_MIN_AGE", "600"))             # giây, ảnh mới hơn không bị xoá
+IMAGE_SWEEP_INTERVAL = float(os.getenv("IMAGE_SWEEP_INTERVAL", "600"))
+TMP_MAX_AGE = float(os.getenv("IMAGE_TMP_MAX_AGE", "600"))           # file tạm render dở quá bấy lâu -> xoá
+# 1 năm: ảnh theo nội dung, đổi dữ liệu là đổi tên file
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "300"))
+
+_MANAGED = re.compile(r"^table_.+_(?P<digest>[0-9a-f]{16})(?P<variant>(?:_p\d+)?(?:_preview)?)\.png$")
+_TMP = re.compile(r"^table_.+\.tmp\.png$")
+
+_SWEEPER: threading.Thread | None = None
+_SWEEPER_STOP = threading.Event()
+_LOCK = threading.Lock()
+_STATS = {"files": 0, "bytes": 0}
+
+def image_path(name: str) -> str:
+    """Đường dẫn ghi ảnh tên name trong IMAGE_DIR."""
+    return os.path.join(IMAGE_DIR, name)
+
+def url_path(path: str) -> str:
+    """Đường dẫn URL (tương đối với PUBLIC_BASE_URL) của ảnh path, xem route /static/ trong app.py."""
+    return f"static/{os.path.basename(path)}"
+
+def preview_path(path: str) -> str:
+    """Ảnh preview (thu nhỏ) đi kèm ảnh báo cáo path."""
+    return f"{os.path.splitext(path)[0]}_preview.png"
+
+def page_path(path: str, page: int) -> str:
+    """Trang thứ page (đếm từ 1) của báo cáo có ảnh trang đầu là path."""
+    return path if page == 1 else f"{os.path.splitext(path)[0]}_p{page}.png"
+
+def pages(path: str) -> list[str]:
+    """Các trang đang có của báo cáo path (trang 1 được ghi sau cùng: có trang 1 là đủ bộ)."""
+    if not os.path.exists(path):
+        return []
+    out = [path]
+    while os.path.exists(nxt := page_path(path, len(out) + 1)):
+        out.append(nxt)
+    return out
+
+def touch(*paths: str) -> None:
+    """Đánh dấu ảnh vừa được dùng lại (render cache hit) -> TTL / LRU tính từ bây giờ."""
+    for path in paths:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+def _remove(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+def sweep(now: float | None = None) -> dict:
+    """
+    1 lượt dọn: file tạm quá TMP_MAX_AGE, ảnh quá TTL, rồi ảnh cũ nhất tới khi tổng <= giới hạn.
+    Returns:
+        {"files", "bytes", "expired", "evicted", "tmp"} sau lượt dọn.
+    """
+    now = time.time() if now is None else now
+    out = {"expired": 0, "evicted": 0, "tmp": 0}
+    groups = {}  # tên tới hết digest -> [mtime mới nhất, tổng size, [path...]]: trang + preview của 1 báo cáo
+    try:
+        entries = list(os.scandir(IMAGE_DIR))
+    except OSError as e:
+        print(f"[image-store][ERROR] {IMAGE_DIR}: {e}")
+        return {**out, "files": 0, "bytes": 0}
+    for entry in entries:
+        if not entry.is_file():
+            continue
+        try:
+            st = entry.stat()
+        except OSError:
+            continue  # vừa bị xoá bởi worker khác
+        if _TMP.match(entry.name):
+            if now - st.st_mtime > TMP_MAX_AGE and _remove(entry.path):
+                out["tmp"] += 1
+        elif m := _MANAGED.match(entry.name):
+            g = groups.setdefault(entry.name[:m.end("digest")], [0.0, 0, []])
+            g[0] = max(g[0], st.st_mtime)
+            g[1] += st.st_size
+            g[2].append(entry.path)
+
+    images = []  # (mtime, size, paths) của các nhóm còn giữ
+    for mtime, size, paths in groups.values():
+        age = now - mtime
+        if age > IMAGE_TTL and age > IMAGE_MIN_AGE:
+            out["expired"] += sum(_remove(p) for p in paths)
+        else:
+            images.append((mtime, size, paths))
+
+    total = sum(size for _, size, _ in images)
+    kept = sum(len(paths) for _, _, paths in images)
+    limit = IMAGE_STORE_MAX_MB * 1e6
+    if total > limit:
+        for mtime, size, paths in sorted(images, key=lambda g: g[0]):
+            if total <= limit:
+                break
+            if now - mtime < IMAGE_MIN_AGE:
+                break  # còn lại toàn ảnh mới -> chấp nhận vượt tạm thời
+            removed = sum(_remove(p) for p in paths)
+            out["evicted"] += removed
+            kept -= removed
+            total -= size
+    with _LOCK:
+        _STATS.update(files=kept, bytes=total)
+    for kind in ("expired", "evicted", "tmp"):
+        if out[kind]:
+            metrics.inc("linebot_image_store_removed_total", out[kind], help="Số file ảnh bị dọn theo lý do", reason=kind)
+    if out["expired"] or out["evicted"] or out["tmp"]:
+        print(f"[image-store] sweep: expired={out['expired']} evicted={out['evicted']} tmp={out['tmp']} "
+              f"-> {kept} ảnh, {total / 1e6:.1f}MB")
+    return {**out, "files": kept, "bytes": total}
+
+def _sweep_loop(interval: float) -> None:
+    while True:
+        try:
+            sweep()
+        except Exception as e:
+            print(f"[image-store][ERROR] sweep: {e}")
+        if _SWEEPER_STOP.wait(interval):
+            return
+
+def start_sweeper(interval: float = IMAGE_SWEEP_INTERVAL) -> None:
+    """Bật thread nền dọn static/ (chạy 1 lượt ngay rồi lặp lại mỗi interval giây)."""
+    global _SWEEPER
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    with _LOCK:
+        if _SWEEPER is not None and _SWEEPER.is_alive():
+            return
+        _SWEEPER_STOP.clear()
+        _SWEEPER = threading.Thread(target=_sweep_loop, args=(interval,), name="image-sweeper", daemon=True)
+        _SWEEPER.start()
+    print(f"[image-store] sweeper started (max={IMAGE_STORE_MAX_MB:.0f}MB, ttl={IMAGE_TTL / 3600:.0f}h, "
+          f"interval={interval}s)")
+
+def stop_sweeper() -> None:
+    _SWEEPER_STOP.set()
+
+def stats() -> dict:
+    with _LOCK:
+        return dict(_STATS)
+
+metrics.gauge("linebot_image_store_bytes", "Tổng dung lượng ảnh báo cáo (lượt dọn gần nhất)", lambda: stats()["bytes"])
+metrics.gauge("linebot_image_store_files", "Số ảnh báo cáo (lượt dọn gần nhất)", lambda: stats()["files"])
+
+def send(filename: str):
+    """
+    Trả file cho route /static/ (Flask view): ảnh báo cáo từ IMAGE_DIR, file khác từ static/.
+    Ảnh theo nội dung: ETag mạnh = digest + hậu tố trang / preview, cache 1 năm immutable.
+    File được gửi qua wsgi.file_wrapper (gunicorn dùng sendfile) hoặc X-Sendfile nếu USE_X_SENDFILE bật.
+    """
+    m = _MANAGED.match(os.path.basename(filename))
+    if m is None:
+        return send_from_directory("static", filename, max_age=STATIC_MAX_AGE)
+    etag = m.group("digest") + m.group("variant")  # mỗi trang / preview 1 ETag riêng
+    resp = send_from_directory(IMAGE_DIR, filename, etag=etag, max_age=IMMUTABLE_MAX_AGE)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
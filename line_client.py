@@ -0,0 +1,82 @@
+# line_client.py
+"""
+LINE Messaging API client dùng chung cho reply (app.py) và push theo lịch (scheduler.py).
+- 1 ApiClient sống suốt process: urllib3 giữ kết nối keep-alive trong pool,
+  không phải bắt tay TCP/TLS lại cho mỗi tin nhắn.
+- Pool size chỉnh qua env LINE_POOL_SIZE (số kết nối song song tới api.line.me).
+- Mỗi lần gọi API đều đo latency; xem latency_stats().
+- LINE_API_HOST: đổi endpoint API (vd. stub local của bench/bench_webhook.py), mặc định api.line.me.
+"""
+
+import os
+import time
+import threading
+from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
+from metrics import observe, STAGE_SECONDS
+
+CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
+LINE_POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", "10"))
+LINE_API_HOST = os.getenv("LINE_API_HOST", "")
+
+_API: MessagingApi | None = None
+_API_LOCK = threading.Lock()
+
+# {op: {"count", "errors", "total_ms", "max_ms", "last_ms"}}
+_LATENCY: dict[str, dict] = {}
+_LATENCY_LOCK = threading.Lock()
+
+def get_api() -> MessagingApi:
+    """MessagingApi dùng chung (thread-safe: PoolManager của urllib3 tự cấp phát kết nối)."""
+    global _API
+    with _API_LOCK:
+        if _API is None:
+            cfg = Configuration(access_token=CHANNEL_ACCESS_TOKEN, host=LINE_API_HOST or None)
+            cfg.connection_pool_maxsize = LINE_POOL_SIZE
+            _API = MessagingApi(ApiClient(cfg))
+            print(f"[line] client ready (pool={LINE_POOL_SIZE}, host={LINE_API_HOST or 'api.line.me'})")
+        return _API
+
+def _record(op: str, ms: float, ok: bool) -> None:
+    with _LATENCY_LOCK:
+        st = _LATENCY.setdefault(op, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0})
+        st["count"] += 1
+        st["errors"] += 0 if ok else 1
+        st["total_ms"] += ms
+        st["max_ms"] = max(st["max_ms"], ms)
+        st["last_ms"] = ms
+
+def _call(op: str, request):
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        result = getattr(get_api(), op)(request)
+        ok = True
+        return result
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        _record(op, ms, ok)
+        observe(STAGE_SECONDS, ms / 1000, stage="line_api", op=op, outcome="ok" if ok else "error")
+        print(f"[line] {op} {'OK' if ok else 'ERROR'} {ms:.0f}ms")
+
+def reply_message(request):
+    return _call("reply_message", request)
+
+def push_message(request):
+    return _call("push_message", request)
+
+def multicast(request):
+    return _call("multicast", request)
+
+def latency_stats() -> dict:
+    """Snapshot latency theo loại API: count, errors, avg_ms, max_ms, last_ms."""
+    with _LATENCY_LOCK:
+        return {
+            op: {
+                "count": st["count"],
+                "errors": st["errors"],
+                "avg_ms": round(st["total_ms"] / st["count"], 1) if st["count"] else 0.0,
+                "max_ms": round(st["max_ms"], 1),
+                "last_ms": round(st["last_ms"], 1),
+            }
+            for op, st in _LATENCY.items()
+        }
@@ -0,0 +1,265 @@
+# metrics.py
+"""
+Đo thời gian từng bước xử lý request + đếm kết quả, xuất dạng text Prometheus cho /metrics.
+- stage(name, **labels): context manager đo 1 bước -> histogram linebot_stage_seconds
+  (outcome="ok" hoặc "error" nếu có exception; đổi outcome bằng st.outcome = "...").
+- observe()/inc(): ghi trực tiếp khi đã có số đo.
+- gauge(name, help, fn): giá trị đọc lúc scrape (kích thước cache, dữ liệu...).
+Registry nằm trong từng process; nhiều worker gunicorn thì mỗi process ghi registry của mình ra
+METRICS_DIR (mặc định /dev/shm, start_exporter() + lúc scrape) và render() cộng dồn file của mọi
+worker: counter / histogram là tổng (giữ cả số của worker đã chết để không bị tụt), gauge thêm
+nhãn pid, chỉ lấy worker còn sống. METRICS_DIR="" -> chỉ số của process nhận request scrape.
+"""
+
+import os
+import glob
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+# giây; đủ rộng cho cả bước ms (tra index) lẫn render ảnh vài giây
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_LOCK = threading.Lock()
+_HELP: dict[str, tuple[str, str]] = {}                      # name -> (type, help)
+_HIST: dict[str, dict[tuple, list]] = {}                    # name -> {labels: [bucket counts..., sum, count]}
+_COUNTERS: dict[str, dict[tuple, float]] = {}               # name -> {labels: value}
+_GAUGES: dict[str, object] = {}                             # name -> fn() -> {labels dict | None: value}
+
+METRICS_DIR = os.getenv("METRICS_DIR", "/dev/shm/linebot-metrics" if os.path.isdir("/dev/shm") else "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))   # giây giữa 2 lần ghi registry ra file
+_EXPORTER: threading.Thread | None = None
+
+STAGE_SECONDS = "linebot_stage_seconds"
+_HELP[STAGE_SECONDS] = ("histogram", "Thời gian từng bước xử lý request (verify, dispatch, load, filter, flex, render, line_api...)")
+
+def _key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+def _set_help(name: str, kind: str, help: str) -> None:
+    # gọi trong _LOCK; lời gọi đầu tiên có thể không kèm help -> lần sau có help thì vẫn ghi vào
+    if help or name not in _HELP:
+        _HELP[name] = (kind, help)
+
+def observe(name: str, seconds: float, help: str = "", **labels) -> None:
+    """Ghi 1 số đo vào histogram name."""
+    key = _key(labels)
+    with _LOCK:
+        _set_help(name, "histogram", help)
+        series = _HIST.setdefault(name, {})
+        h = series.get(key)
+        if h is None:
+            h = series[key] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, b in enumerate(BUCKETS):
+            if seconds <= b:
+                h[i] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+def inc(name: str, value: float = 1.0, help: str = "", **labels) -> None:
+    """Cộng counter name."""
+    key = _key(labels)
+    with _LOCK:
+        _set_help(name, "counter", help)
+        series = _COUNTERS.setdefault(name, {})
+        series[key] = series.get(key, 0.0) + value
+
+def gauge(name: str, help: str, fn) -> None:
+    """Đăng ký gauge đọc lúc scrape: fn() -> số, hoặc {tuple(labels.items()): số}."""
+    with _LOCK:
+        _HELP[name] = ("gauge", help)
+        _GAUGES[name] = fn
+
+class _Stage:
+    __slots__ = ("outcome",)
+
+    def __init__(self):
+        self.outcome = "ok"
+
+@contextmanager
+def stage(name: str, **labels):
+    """
+    Đo 1 bước:  with stage("filter", report=report_id) as st: ...
+    Exception -> outcome="error" (exception vẫn ném tiếp).
+    """
+    st = _Stage()
+    t0 = time.perf_counter()
+    try:
+        yield st
+    except BaseException:
+        st.outcome = "error"
+        raise
+    finally:
+        observe(STAGE_SECONDS, time.perf_counter() - t0, stage=name, outcome=st.outcome, **labels)
+
+def summary(name: str = STAGE_SECONDS) -> dict:
+    """{labels: {"count", "avg_ms"}} của 1 histogram (cho script / bench đọc nhanh)."""
+    with _LOCK:
+        series = {k: (v[-1], v[-2]) for k, v in _HIST.get(name, {}).items()}
+    return {k: {"count": n, "avg_ms": round(total / n * 1000, 2) if n else 0.0} for k, (n, total) in series.items()}
+
+def _gauge_values(gauges: dict) -> dict[str, dict[tuple, float]]:
+    out = {}
+    for name, fn in gauges.items():
+        try:
+            values = fn()
+        except Exception as e:
+            print(f"[metrics][ERROR] gauge {name}: {e}")
+            continue
+        if not isinstance(values, dict):
+            values = {(): values}
+        out[name] = {_key(dict(key)): v for key, v in values.items()}
+    return out
+
+def _local() -> dict:
+    """Registry của process này (gauge đã đọc giá trị)."""
+    with _LOCK:
+        out = {
+            "help": dict(_HELP),
+            "hist": {n: {k: list(v) for k, v in s.items()} for n, s in _HIST.items()},
+            "counters": {n: dict(s) for n, s in _COUNTERS.items()},
+        }
+        gauges = dict(_GAUGES)
+    out["gauges"] = _gauge_values(gauges)
+    return out
+
+# region Nhiều process (METRICS_DIR)
+def _own_file() -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+
+def _dump() -> None:
+    """Ghi registry của process ra file riêng (file tạm rồi os.replace -> process khác không đọc file dở)."""
+    data = _local()
+    doc = {
+        "help": data["help"],
+        "hist": {n: [[list(k), v] for k, v in s.items()] for n, s in data["hist"].items()},
+        "counters": {n: [[list(k), v] for k, v in s.items()] for n, s in data["counters"].items()},
+        "gauges": {n: [[list(k), v] for k, v in s.items()] for n, s in data["gauges"].items()},
+    }
+    out = _own_file()
+    tmp = f"{out}.tmp"
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(doc, f, ensure_ascii=False)
+    os.replace(tmp, out)
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def _merged() -> dict:
+    """Cộng dồn registry của mọi process trong METRICS_DIR (process hiện tại ghi lại trước cho mới)."""
+    _dump()
+    out = {"help": {}, "hist": {}, "counters": {}, "gauges": {}, "pids": []}
+    for file in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+        try:
+            pid = int(os.path.basename(file)[len("metrics-"):-len(".json")])
+            with open(file, encoding="utf-8") as f:
+                doc = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[metrics][ERROR] {file}: {e}")
+            continue
+        alive = _alive(pid)
+        for name, (kind, text) in doc.get("help", {}).items():
+            if text or name not in out["help"]:
+                out["help"][name] = (kind, text)
+        for name, series in doc.get("hist", {}).items():
+            dst = out["hist"].setdefault(name, {})
+            for key, h in series:
+                key = tuple(map(tuple, key))
+                cur = dst.get(key)
+                if cur is None:
+                    dst[key] = list(h)
+                elif len(cur) == len(h):
+                    dst[key] = [a + b for a, b in zip(cur, h)]
+        for name, series in doc.get("counters", {}).items():
+            dst = out["counters"].setdefault(name, {})
+            for key, v in series:
+                key = tuple(map(tuple, key))
+                dst[key] = dst.get(key, 0.0) + v
+        if alive:
+            # gauge là giá trị hiện tại của từng worker -> tách theo pid, bỏ worker đã chết
+            out["pids"].append(pid)
+            for name, series in doc.get("gauges", {}).items():
+                dst = out["gauges"].setdefault(name, {})
+                for key, v in series:
+                    dst[tuple(sorted(map(tuple, key + [["pid", str(pid)]])))] = v
+    return out
+
+def _export_loop() -> None:
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            _dump()
+        except Exception as e:
+            print(f"[metrics][ERROR] export: {e}")
+
+def start_exporter() -> None:
+    """Bật thread nền ghi registry ra METRICS_DIR định kỳ (để worker khác tổng hợp lúc scrape)."""
+    global _EXPORTER
+    if not METRICS_DIR:
+        return
+    with _LOCK:
+        if _EXPORTER is not None and _EXPORTER.is_alive():
+            return
+        _EXPORTER = threading.Thread(target=_export_loop, name="metrics-export", daemon=True)
+        _EXPORTER.start()
+    atexit.register(_dump)  # số cuối cùng của worker khi thoát bình thường
+    print(f"[metrics] exporter started ({METRICS_DIR}, interval={METRICS_FLUSH_INTERVAL}s)")
+# endregion
+
+# region Text exposition
+def _fmt_labels(key: tuple, extra: tuple = ()) -> str:
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+def _fmt_value(v: float) -> str:
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+def render() -> str:
+    """Toàn bộ metric dạng text Prometheus (version 0.0.4): tổng của mọi worker nếu có METRICS_DIR."""
+    if METRICS_DIR:
+        data = _merged()
+    else:
+        data = _local()
+        data["pids"] = [os.getpid()]
+    hist, counters, gauges, helps = data["hist"], data["counters"], data["gauges"], data["help"]
+    lines = []
+
+    def header(name):
+        kind, text = helps.get(name, ("untyped", ""))
+        if text:
+            lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for name in sorted(hist):
+        header(name)
+        for key, h in sorted(hist[name].items()):
+            for b, n in zip(BUCKETS, h):
+                lines.append(f"{name}_bucket{_fmt_labels(key, (('le', repr(b)),))} {n}")
+            lines.append(f"{name}_bucket{_fmt_labels(key, (('le', '+Inf'),))} {h[-1]}")
+            lines.append(f"{name}_sum{_fmt_labels(key)} {h[-2]:.6f}")
+            lines.append(f"{name}_count{_fmt_labels(key)} {h[-1]}")
+    for name in sorted(counters):
+        header(name)
+        for key, v in sorted(counters[name].items()):
+            lines.append(f"{name}{_fmt_labels(key)} {_fmt_value(v)}")
+    for name in sorted(gauges):
+        header(name)
+        for key, v in sorted(gauges[name].items()):
+            lines.append(f"{name}{_fmt_labels(key)} {_fmt_value(v)}")
+    lines.append("# TYPE linebot_process_info gauge")
+    for pid in sorted(data["pids"]):
+        lines.append(f'linebot_process_info{{pid="{pid}"}} 1')
+    return "\n".join(lines) + "\n"
+# endregion
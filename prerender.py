@@ -0,0 +1,225 @@
+# prerender.py
+"""
+Render trước các báo cáo hay được xem, ngay sau khi dữ liệu đổi version.
+Sáng sớm (05:30 - 07:00) người dùng đầu tiên luôn gặp ảnh chưa render cho cùng các siêu thị / nhóm hàng quen
+-> render sẵn vào đúng file request sẽ dùng (report._image_path) để request sau chỉ là cache HIT.
+- record(report, store, cat, group): handlers ghi lại mỗi lần người dùng chọn báo cáo. Đếm trong RAM,
+  thread nền flush định kỳ vào SQLite (PRERENDER_DB) dùng chung giữa các worker gunicorn.
+- cache gọi _on_reload(path) sau khi swap version mới -> sau PRERENDER_DELAY giây (gom nhiều file đổi
+  cùng lúc) thread nền chạy run() cho các báo cáo của file đó.
+- run(): render lần lượt PRERENDER_TOP tổ hợp (report, store, cat, group) được xem nhiều nhất trong
+  PRERENDER_HISTORY_DAYS ngày, dừng khi hết ngân sách PRERENDER_BUDGET giây; tải CPU cao hơn
+  PRERENDER_MAX_LOAD thì nhường request thật. Mỗi lần chỉ render 1 ảnh (chiếm 1 worker render).
+  Nhiều worker gunicorn cùng thấy version mới -> chỉ 1 worker chạy (file lock), worker khác bỏ qua.
+Job APScheduler (scheduler.init_scheduler) gọi run() thêm 1 lần trước giờ gửi tin buổi sáng.
+PRERENDER_TOP=0 -> tắt.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import cache
+import metrics
+import report
+from config import DATA_PATH_FOR_REPORT, CATEGORIES
+
+try:
+    import fcntl  # khoá file giữa các worker (Linux); không có thì bỏ qua khoá
+except ImportError:
+    fcntl = None
+
+PRERENDER_DB = os.getenv("PRERENDER_DB", "./data/report_history.sqlite")
+PRERENDER_TOP = int(os.getenv("PRERENDER_TOP", "200"))                     # số tổ hợp render trước tối đa / lượt
+PRERENDER_BUDGET = float(os.getenv("PRERENDER_BUDGET", "300"))             # giây tối đa / lượt
+PRERENDER_MAX_LOAD = float(os.getenv("PRERENDER_MAX_LOAD", "0.75"))        # load average / CPU, vượt thì tạm dừng
+PRERENDER_HISTORY_DAYS = int(os.getenv("PRERENDER_HISTORY_DAYS", "14"))
+PRERENDER_DELAY = float(os.getenv("PRERENDER_DELAY", "30"))                # giây chờ sau reload (gom file đổi cùng lúc)
+FLUSH_INTERVAL = float(os.getenv("PRERENDER_FLUSH_INTERVAL", "60"))        # giây giữa 2 lần ghi lịch sử xuống SQLite
+LOAD_WAIT = 5.0
+
+_HITS: Counter = Counter()          # (ngày, report, store, cat, group) -> số lần, chưa ghi xuống DB
+_PENDING: dict[str, float] = {}     # path dữ liệu vừa đổi -> thời điểm được render trước
+_LOCK = threading.Lock()
+_WAKE = threading.Event()
+_STOP = threading.Event()
+_THREAD: threading.Thread | None = None
+
+# region Lịch sử request
+def record(report_id: str, store_id, cat_id, group: str) -> None:
+    """Ghi nhận 1 lần xem báo cáo (gọi trong request, chỉ cộng counter trong RAM)."""
+    if PRERENDER_TOP <= 0 or report_id not in DATA_PATH_FOR_REPORT:
+        return
+    try:
+        key = (date.today().isoformat(), report_id, int(store_id), int(cat_id), str(group))
+    except (TypeError, ValueError):
+        return
+    with _LOCK:
+        _HITS[key] += 1
+
+def _connect() -> sqlite3.Connection:
+    con = sqlite3.connect(PRERENDER_DB, timeout=10)
+    con.execute("CREATE TABLE IF NOT EXISTS report_hits (day TEXT NOT NULL, report TEXT NOT NULL, "
+                "store INTEGER NOT NULL, cat INTEGER NOT NULL, grp TEXT NOT NULL, n INTEGER NOT NULL, "
+                "PRIMARY KEY (day, report, store, cat, grp))")
+    return con
+
+def flush() -> int:
+    """Ghi counter trong RAM xuống SQLite (cộng dồn), xoá lịch sử quá hạn. Returns: số dòng đã ghi."""
+    with _LOCK:
+        hits = dict(_HITS)
+        _HITS.clear()
+    if not hits:
+        return 0
+    cutoff = (date.today() - timedelta(days=PRERENDER_HISTORY_DAYS)).isoformat()
+    try:
+        with _connect() as con:
+            con.executemany(
+                "INSERT INTO report_hits (day, report, store, cat, grp, n) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (day, report, store, cat, grp) DO UPDATE SET n = n + excluded.n",
+                [(*key, n) for key, n in hits.items()],
+            )
+            con.execute("DELETE FROM report_hits WHERE day < ?", (cutoff,))
+        con.close()
+    except sqlite3.Error as e:
+        # DB lỗi / bị khoá lâu -> trả lại counter, lần sau ghi tiếp
+        print(f"[prerender][ERROR] flush history: {e}")
+        with _LOCK:
+            _HITS.update(hits)
+        return 0
+    return len(hits)
+
+def top_requests(limit: int = PRERENDER_TOP, reports=None) -> list[tuple[str, int, int, str]]:
+    """[(report, store, cat, group)] xem nhiều nhất trong PRERENDER_HISTORY_DAYS ngày, nhiều nhất trước."""
+    if limit <= 0 or not os.path.exists(PRERENDER_DB):
+        return []
+    reports = list(reports or DATA_PATH_FOR_REPORT)
+    cutoff = (date.today() - timedelta(days=PRERENDER_HISTORY_DAYS)).isoformat()
+    with _connect() as con:
+        rows = con.execute(
+            f"SELECT report, store, cat, grp FROM report_hits "
+            f"WHERE day >= ? AND report IN ({','.join('?' * len(reports))}) "
+            f"GROUP BY report, store, cat, grp ORDER BY SUM(n) DESC, MAX(day) DESC LIMIT ?",
+            (cutoff, *reports, limit),
+        ).fetchall()
+    con.close()
+    return rows
+# endregion
+
+# region Render trước
+@contextmanager
+def _exclusive():
+    """Khoá không chờ giữa các worker: True nếu process này được chạy lượt render trước."""
+    if fcntl is None:
+        yield True
+        return
+    with open(f"{PRERENDER_DB}.lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        yield True
+
+def _cpu_busy() -> bool:
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1) > PRERENDER_MAX_LOAD
+    except OSError:
+        return False
+
+def run(paths=None, budget: float = PRERENDER_BUDGET) -> dict:
+    """
+    1 lượt render trước các báo cáo hay xem nhất (chỉ của các file trong paths nếu có).
+    Returns:
+        số tổ hợp theo kết quả {"rendered", "cache_hit", "empty", "busy", "skipped"}.
+    """
+    if PRERENDER_TOP <= 0:
+        return {}
+    reports = [r for r, p in DATA_PATH_FOR_REPORT.items() if paths is None or p in paths]
+    if not reports:
+        return {}
+    out = Counter()
+    with _exclusive() as owner:
+        if not owner:
+            print("[prerender] worker khác đang render trước -> bỏ qua")
+            return {}
+        flush()
+        t0 = time.monotonic()
+        deadline = t0 + budget
+        todo = top_requests(PRERENDER_TOP, reports)
+        cat_names = {str(c["id"]): c["title"] for c in CATEGORIES}
+        for i, (report_id, store_id, cat_id, group) in enumerate(todo):
+            while _cpu_busy() and time.monotonic() + LOAD_WAIT < deadline and not _STOP.is_set():
+                time.sleep(LOAD_WAIT)  # nhường CPU cho request thật
+            if time.monotonic() >= deadline or _STOP.is_set():
+                out["skipped"] += len(todo) - i
+                break
+            try:
+                outcome = report.prerender(report_id, DATA_PATH_FOR_REPORT[report_id], store_id, cat_id,
+                                           cat_names.get(str(cat_id), str(cat_id)), group)
+            except Exception as e:
+                # tổ hợp cũ không còn hợp lệ với dữ liệu mới... -> bỏ qua, render tiếp
+                print(f"[prerender][ERROR] {report_id} store={store_id} cat={cat_id} group={group!r}: {e}")
+                outcome = "error"
+            out[outcome] += 1
+    for outcome, n in out.items():
+        metrics.inc("linebot_prerender_total", n, help="Số tổ hợp báo cáo render trước theo kết quả", outcome=outcome)
+    if todo:
+        print(f"[prerender] {len(todo)} tổ hợp trong {time.monotonic() - t0:.1f}s: "
+              + " ".join(f"{k}={v}" for k, v in sorted(out.items())))
+    return dict(out)
+
+def _on_reload(path: str, version: str) -> None:
+    """Listener của cache: file vừa swap version mới -> hẹn render trước sau PRERENDER_DELAY."""
+    if path not in DATA_PATH_FOR_REPORT.values():
+        return
+    with _LOCK:
+        _PENDING.setdefault(path, time.monotonic() + PRERENDER_DELAY)
+    _WAKE.set()
+
+def _loop() -> None:
+    while not _STOP.is_set():
+        _WAKE.clear()
+        with _LOCK:
+            now = time.monotonic()
+            due = [p for p, at in _PENDING.items() if at <= now]
+            wait = min([at - now for at in _PENDING.values() if at > now] + [FLUSH_INTERVAL])
+            for p in due:
+                del _PENDING[p]
+        try:
+            if due:
+                run(paths=due)
+            else:
+                flush()
+        except Exception as e:
+            print(f"[prerender][ERROR] {e}")
+        _WAKE.wait(wait)
+
+def start() -> None:
+    """Bật thread nền: ghi lịch sử định kỳ + render trước sau mỗi lần reloader đổi version dữ liệu."""
+    global _THREAD
+    if PRERENDER_TOP <= 0:
+        return
+    with _LOCK:
+        if _THREAD is not None and _THREAD.is_alive():
+            return
+        _STOP.clear()
+        # dữ liệu có thể đã đổi trong lúc process không chạy (deploy / restart) -> 1 lượt sau boot;
+        # ảnh đã có chỉ tốn 1 lần stat
+        for path in set(DATA_PATH_FOR_REPORT.values()):
+            _PENDING.setdefault(path, time.monotonic() + PRERENDER_DELAY)
+        _THREAD = threading.Thread(target=_loop, name="prerender", daemon=True)
+        _THREAD.start()
+    cache.on_reload(_on_reload)
+    print(f"[prerender] started (top={PRERENDER_TOP}, budget={PRERENDER_BUDGET:.0f}s, "
+          f"max_load={PRERENDER_MAX_LOAD})")
+
+def stop() -> None:
+    _STOP.set()
+    _WAKE.set()
+    flush()
+# endregion
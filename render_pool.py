@@ -0,0 +1,166 @@
+# render_pool.py
+"""
+Dịch vụ render ảnh báo cáo trong process pool riêng.
+- Render (Pillow / matplotlib) chạy ở process khác -> không giữ GIL, không đụng pyplot
+  global state của web worker; request nhanh (menu, vị trí, ping) vẫn chạy bình thường.
+- Worker được khởi động sẵn lúc boot (start()), mỗi job có deadline (RENDER_TIMEOUT).
+- Worker crash / treo quá deadline -> bỏ pool cũ, tạo pool mới; request đó nhận RenderError,
+  các job khác đang chạy trên pool cũ được chạy lại 1 lần trên pool mới.
+RENDER_WORKERS=0 -> render ngay trong thread hiện tại (chế độ cũ, tiện khi dev/debug).
+"""
+
+import os
+import glob
+import time
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import renderer
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2"))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "20"))
+# tối đa số job đang chờ + đang chạy; vượt quá thì request chờ slot trong deadline
+RENDER_QUEUE = int(os.getenv("RENDER_QUEUE", str(max(1, RENDER_WORKERS) * 4)))
+
+_POOL: ProcessPoolExecutor | None = None
+_POOL_LOCK = threading.Lock()
+_SLOTS = threading.BoundedSemaphore(RENDER_QUEUE)
+
+class RenderError(RuntimeError):
+    """Render không xong trong deadline hoặc worker render bị crash."""
+
+def _mp_context():
+    # forkserver: worker fork từ 1 process sạch (không kế thừa thread của gunicorn/APScheduler),
+    # preload sẵn renderer (matplotlib, Pillow) nên tạo worker mới rất nhanh.
+    if "forkserver" in mp.get_all_start_methods():
+        ctx = mp.get_context("forkserver")
+        ctx.set_forkserver_preload(["renderer"])
+        return ctx
+    return mp.get_context("spawn")
+
+def _warmup() -> int:
+    # nạp font trước để job đầu tiên không phải trả giá
+    renderer._font(28)
+    renderer._font(28, bold=True)
+    return os.getpid()
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=_mp_context())
+            # mỗi worker 1 job warm-up -> pool dựng đủ process ngay
+            for _ in range(RENDER_WORKERS):
+                _POOL.submit(_warmup)
+            print(f"[render-pool] started {RENDER_WORKERS} worker(s), timeout={RENDER_TIMEOUT}s")
+        return _POOL
+
+def _recycle(pool: ProcessPoolExecutor, reason: str) -> None:
+    """Bỏ pool lỗi (kill worker treo/crash); lần submit sau tự tạo pool mới."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not pool:
+            return  # thread khác đã recycle rồi
+        _POOL = None
+    print(f"[render-pool] recycle pool: {reason}")
+    procs = list((getattr(pool, "_processes", None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for p in procs:
+        if p.is_alive():
+            p.terminate()
+
+def _discard_partial(*outfiles: str | None) -> None:
+    """Xoá file tạm do worker bị kill giữa chừng để lại (xem renderer.render_table)."""
+    for outfile in filter(None, outfiles):
+        for tmp in glob.glob(f"{glob.escape(os.path.splitext(outfile)[0])}.*.tmp.png"):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+def is_worker_process() -> bool:
+    """
+    True nếu đang ở trong process con của multiprocessing.
+    Worker spawn/forkserver import lại module main (app.py) trước khi chạy job
+    (_inheriting=True lúc đó) -> code boot của app không được chạy lại trong worker.
+    """
+    return getattr(mp.current_process(), "_inheriting", False) or mp.parent_process() is not None
+
+def start() -> None:
+    """Khởi động worker trước (gọi lúc boot app). Không làm gì nếu RENDER_WORKERS=0."""
+    if is_worker_process():
+        return  # không dựng pool lồng nhau trong worker
+    if RENDER_WORKERS > 0:
+        _get_pool()
+
+def shutdown() -> None:
+    """Dừng worker render (script / bench trước khi thoát), lần render sau tự tạo pool mới."""
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def _run(fn, args: tuple, kwargs: dict, outfiles: list, timeout: float | None):
+    """
+    Chạy fn(*args, **kwargs) trong pool, chờ tối đa timeout giây; lỗi thì dọn file tạm của outfiles.
+    Recycle pool (do job khác treo / crash) giết cả các job đang chạy cùng pool -> job bị vạ lây
+    (BrokenProcessPool) được chạy lại 1 lần trên pool mới nếu còn deadline, không tính là lỗi của nó.
+    """
+    timeout = RENDER_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    if not _SLOTS.acquire(timeout=timeout):
+        raise RenderError(f"render queue full ({RENDER_QUEUE})")
+    try:
+        for attempt in (1, 2):
+            pool = _get_pool()
+            try:
+                try:
+                    fut = pool.submit(fn, *args, **kwargs)
+                except RuntimeError:
+                    # pool vừa bị thread khác recycle -> submit lại vào pool mới
+                    pool = _get_pool()
+                    fut = pool.submit(fn, *args, **kwargs)
+                return fut.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeout:
+                _recycle(pool, f"timeout {timeout}s rendering {outfiles[0]}")
+                _discard_partial(*outfiles)
+                raise RenderError(f"render timeout after {timeout}s")
+            except BrokenProcessPool as e:
+                _recycle(pool, f"worker crashed: {e}")
+                _discard_partial(*outfiles)
+                if attempt == 2 or time.monotonic() >= deadline:
+                    raise RenderError(f"render worker crashed: {e}")
+                print(f"[render-pool] pool hỏng khi đang render {outfiles[0]} -> chạy lại trên pool mới")
+    finally:
+        _SLOTS.release()
+
+def render_table(kind: str, df, outfile: str, title: str, timeout: float | None = None,
+                 preview: str | None = None):
+    """
+    Giống renderer.render_table nhưng chạy trong process pool, chờ tối đa timeout giây.
+    preview: đường dẫn ảnh thu nhỏ, ghi cùng lần render (tuỳ chọn).
+    Returns:
+        outfile nếu tạo được ảnh, None nếu không (vd. bảng rỗng).
+    Raises:
+        RenderError: quá deadline hoặc worker crash.
+    """
+    if RENDER_WORKERS <= 0:
+        return renderer.render_table(kind, df, outfile, title, preview=preview)
+    return _run(renderer.render_table, (kind, df, outfile, title), {"preview": preview},
+                [outfile, preview], timeout)
+
+def render_pages(kind: str, df, outfiles: list[str], title: str, previews: list[str] | None = None,
+                 timeout: float | None = None) -> list[str]:
+    """
+    Giống renderer.render_pages (nhiều trang, render lần lượt) nhưng chạy trong process pool,
+    cả bộ trang chung 1 deadline.
+    Raises:
+        RenderError: quá deadline hoặc worker crash.
+    """
+    if RENDER_WORKERS <= 0:
+        return renderer.render_pages(kind, df, outfiles, title, previews=previews)
+    return _run(renderer.render_pages, (kind, df, outfiles, title), {"previews": previews},
+                list(outfiles) + list(previews or []), timeout)
@@ -0,0 +1,244 @@
+# renderer.py
+"""
+Render bảng báo cáo (DataFrame) ra ảnh PNG qua nhiều backend thay thế được.
+- "pil": vẽ trực tiếp bằng Pillow (nhanh, ít RAM) — mặc định.
+- "matplotlib": df_nhucau_to_image / df_nhapban_to_image cũ trong utils — dự phòng.
+Chọn backend qua env TABLE_RENDERER; backend lỗi -> tự rơi về matplotlib.
+Ảnh ra được nén palette (IMAGE_COLORS màu, gần như không đổi điểm ảnh vì bảng chỉ có vài màu nền + chữ
+khử răng cưa) và có thể kèm ảnh preview thu nhỏ (PREVIEW_WIDTH px) từ cùng 1 lần vẽ.
+"""
+
+import os
+import threading
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import matplotlib
+from PIL import Image, ImageDraw, ImageFont
+
+TABLE_RENDERER = os.getenv("TABLE_RENDERER", "pil")
+# số màu palette của ảnh PNG ra (0 = giữ RGB đầy đủ); bảng thường ~700 màu, 256 màu lệch tối đa ~2/255
+IMAGE_COLORS = int(os.getenv("IMAGE_COLORS", "256"))
+PREVIEW_WIDTH = int(os.getenv("PREVIEW_WIDTH", "480"))   # bề rộng ảnh preview (thumbnail trong khung chat)
+# đổi cách mã hoá ảnh -> đổi tag -> report đặt tên file mới thay vì dùng lại ảnh cũ
+OUTPUT_TAG = f"q{IMAGE_COLORS}-p{PREVIEW_WIDTH}"
+
+# ===== CẤU HÌNH BẢNG THEO LOẠI BÁO CÁO =====
+# width_in: bề rộng figure (inch) như bản matplotlib; col_widths: tỉ lệ cột;
+# highlight_col: cột % tô đỏ khi < highlight_below; skip_empty: bảng rỗng thì không vẽ
+TABLE_SPECS = {
+    "nhucau": {
+        "width_in": 9,
+        "col_widths": [0.45, 0.15, 0.15, 0.25],
+        "highlight_col": None,
+        "skip_empty": False,
+    },
+    "nhapban": {
+        "width_in": 11,
+        "col_widths": [0.22, 0.1, 0.1, 0.1, 0.1, 0.12, 0.12, 0.15],
+        "highlight_col": "% Bán/Nhập",
+        "highlight_below": 0.8,
+        "skip_empty": True,
+    },
+}
+
+HEADER_BG = "#4CAF50"
+HEADER_FG = "#FFFFFF"
+STRIPE_BG = ("#ffffff", "#f5f5f5")   # dòng lẻ / dòng chẵn (giống bản matplotlib)
+HIGHLIGHT_BG = "#ffb2b2"             # nền đỏ nhạt
+GRID_COLOR = "#000000"
+
+def highlight_mask(df: pd.DataFrame, spec: dict) -> np.ndarray:
+    """
+    Mảng bool theo dòng: ô highlight_col (dạng "92%") < highlight_below.
+    Parse cả cột 1 lần (vectorized) thay vì df.iloc từng ô.
+    """
+    col = spec.get("highlight_col")
+    if not col or col not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    raw = df[col].astype(str).str.strip().str.replace("%", "", regex=False)
+    vals = pd.to_numeric(raw, errors="coerce") / 100
+    return (vals < spec.get("highlight_below", 0.8)).fillna(False).to_numpy(dtype=bool)
+
+# region PIL backend
+@lru_cache(maxsize=16)
+def _font(size_px: int, bold: bool = False) -> ImageFont.FreeTypeFont:
+    # DejaVuSans đi kèm matplotlib, đủ dấu tiếng Việt -> không cần thêm file font
+    name = "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf"
+    return ImageFont.truetype(os.path.join(matplotlib.get_data_path(), "fonts", "ttf", name), size_px)
+
+def _fit(draw: ImageDraw.ImageDraw, text: str, font, max_w: int) -> str:
+    """Cắt chữ + '…' nếu dài hơn ô."""
+    if max_w <= 0 or draw.textlength(text, font=font) <= max_w:
+        return text
+    while text and draw.textlength(text + "…", font=font) > max_w:
+        text = text[:-1]
+    return text + "…"
+
+def _draw_pil(df, title, spec, dpi=200) -> Image.Image | None:
+    """
+    Ảnh bảng trong RAM (chưa mã hoá), None nếu bảng rỗng mà spec bỏ qua bảng rỗng.
+    Cùng bố cục bản matplotlib: tiêu đề đậm căn giữa, header xanh chữ trắng, sọc ngựa vằn, ô % < 80% nền đỏ.
+    """
+    if spec.get("skip_empty") and len(df) == 0:
+        print("DataFrame is empty, cannot create image.")
+        return None
+
+    pt = dpi / 72.0
+    title_font = _font(round(13 * pt), bold=True)
+    header_font = _font(round(10 * pt), bold=True)
+    body_font = _font(round(10 * pt))
+    margin = round(0.2 * dpi)
+    line_w = max(1, round(0.8 * pt))
+    header_h = round(27 * pt)
+    row_h = round(19.5 * pt)
+
+    table_w = round(spec["width_in"] * dpi * 0.814)
+    col_w = [round(w * table_w / sum(spec["col_widths"])) for w in spec["col_widths"]]
+    col_w = (col_w + [col_w[-1]] * len(df.columns))[:len(df.columns)]
+    table_w = sum(col_w)
+    col_x = np.concatenate([[0], np.cumsum(col_w)]).astype(int)
+
+    title_lines = str(title).split("\n")
+    title_line_h = round(title_font.size * 1.2)
+    title_h = title_line_h * len(title_lines) + round(6 * pt)
+
+    # tiêu đề dài hơn bảng thì nới ảnh ra (như bbox_inches="tight")
+    title_w = max(round(title_font.getlength(line)) for line in title_lines)
+    width = max(table_w, title_w) + 2 * margin
+    height = margin + title_h + header_h + row_h * len(df) + margin
+    img = Image.new("RGB", (width, height), "#ffffff")
+    draw = ImageDraw.Draw(img)
+
+    # --- Tiêu đề ---
+    y = margin
+    for line in title_lines:
+        draw.text((width / 2, y), line, font=title_font, fill="#000000", anchor="ma")
+        y += title_line_h
+    top = margin + title_h
+    left = (width - table_w) // 2
+
+    # --- Header ---
+    draw.rectangle([left, top, left + table_w, top + header_h], fill=HEADER_BG)
+    for c, name in enumerate(df.columns):
+        cx = left + (col_x[c] + col_x[c + 1]) / 2
+        text = _fit(draw, str(name), header_font, col_w[c] - 2 * line_w)
+        draw.text((cx, top + header_h / 2), text, font=header_font, fill=HEADER_FG, anchor="mm")
+
+    # --- Body: nền sọc + highlight, rồi text ---
+    hl = highlight_mask(df, spec)
+    hl_c = list(df.columns).index(spec["highlight_col"]) if hl.any() else None
+    values = df.to_numpy()
+    y0 = top + header_h
+    for r in range(len(df)):
+        ry = y0 + r * row_h
+        # r=0 ứng với dòng 1 của bảng matplotlib (dòng lẻ -> trắng)
+        draw.rectangle([left, ry, left + table_w, ry + row_h], fill=STRIPE_BG[r % 2])
+        if hl_c is not None and hl[r]:
+            draw.rectangle([left + col_x[hl_c], ry, left + col_x[hl_c + 1], ry + row_h], fill=HIGHLIGHT_BG)
+        for c in range(len(col_w)):
+            pad = round(col_w[c] * 0.1)   # matplotlib: PAD = 10% bề rộng ô
+            text = _fit(draw, str(values[r, c]), body_font, col_w[c] - pad - line_w)
+            draw.text((left + col_x[c] + pad, ry + row_h / 2), text, font=body_font, fill="#000000", anchor="lm")
+
+    # --- Lưới ---
+    bottom = y0 + row_h * len(df)
+    for x in col_x:
+        draw.line([(left + x, top), (left + x, bottom)], fill=GRID_COLOR, width=line_w)
+    for yy in [top, y0] + [y0 + (r + 1) * row_h for r in range(len(df))]:
+        draw.line([(left, yy), (left + table_w, yy)], fill=GRID_COLOR, width=line_w)
+    return img
+# endregion
+
+# region Output
+def _encode(img: Image.Image, outfile: str) -> None:
+    """Ghi PNG gọn: palette IMAGE_COLORS màu (MAXCOVERAGE giữ đúng màu nền/chữ hơn octree), không dither."""
+    if IMAGE_COLORS > 0:
+        img = img.quantize(IMAGE_COLORS, method=Image.Quantize.MAXCOVERAGE, dither=Image.Dither.NONE)
+    img.save(outfile, format="PNG")
+
+def _preview(img: Image.Image) -> Image.Image:
+    """Thu nhỏ theo bề rộng PREVIEW_WIDTH, giữ tỉ lệ (ảnh đã nhỏ hơn thì giữ nguyên)."""
+    if img.width <= PREVIEW_WIDTH:
+        return img
+    size = (PREVIEW_WIDTH, max(1, round(img.height * PREVIEW_WIDTH / img.width)))
+    return img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+# endregion
+
+# region Dispatch
+def _matplotlib_backend(kind, df, outfile, title):
+    # import trễ để backend pil không phải kéo pyplot lên
+    from utils import df_nhucau_to_image, df_nhapban_to_image
+    func = df_nhapban_to_image if kind == "nhapban" else df_nhucau_to_image
+    return func(df, outfile=outfile, title=title)
+
+def _pil_backend(kind, df, outfile, title):
+    # trả ảnh trong RAM: render_table mã hoá 1 lần, không phải ghi PNG rồi đọc lại
+    return _draw_pil(df, title, TABLE_SPECS[kind])
+
+RENDERERS = {
+    "pil": _pil_backend,
+    "matplotlib": _matplotlib_backend,
+}
+
+def render_table(kind: str, df: pd.DataFrame, outfile: str, title: str, backend: str | None = None,
+                 preview: str | None = None):
+    """
+    Render bảng loại kind ("nhucau" | "nhapban") ra outfile bằng backend đã chọn.
+    Backend lỗi -> log và thử lại bằng matplotlib. Ảnh được ghi nguyên tử (file tạm + rename).
+    Backend trả ảnh trong RAM (pil) hoặc ghi file (matplotlib); cả 2 đều được mã hoá lại gọn (_encode),
+    preview (nếu có) thu nhỏ từ cùng ảnh đó -> chỉ vẽ 1 lần. Preview được ghi trước ảnh gốc:
+    thấy outfile là có đủ cả 2.
+    Returns:
+        outfile nếu tạo được ảnh, None nếu không (vd. bảng rỗng).
+    """
+    backend = backend or TABLE_RENDERER
+    func = RENDERERS.get(backend, _matplotlib_backend)
+    # ghi ra file tạm rồi os.replace: request khác không bao giờ đọc phải ảnh ghi dở
+    suffix = f"{os.getpid()}-{threading.get_ident()}.tmp.png"
+    tmp = f"{os.path.splitext(outfile)[0]}.{suffix}"
+    try:
+        out = func(kind, df, tmp, title)
+    except Exception as e:
+        if func is _matplotlib_backend:
+            raise
+        print(f"[renderer][{backend}][ERROR] {e} -> fallback matplotlib")
+        out = _matplotlib_backend(kind, df, tmp, title)
+    if isinstance(out, Image.Image):
+        img = out
+    elif out and os.path.exists(tmp):
+        with Image.open(tmp) as f:
+            img = f.convert("RGB")
+    else:
+        return None
+    os.makedirs(os.path.dirname(outfile) or ".", exist_ok=True)
+    if preview:
+        preview_tmp = f"{os.path.splitext(preview)[0]}.{suffix}"
+        _encode(_preview(img), preview_tmp)
+        os.replace(preview_tmp, preview)
+    _encode(img, tmp)
+    os.replace(tmp, outfile)
+    return outfile
+
+def render_pages(kind: str, df: pd.DataFrame, outfiles: list[str], title: str, previews: list[str] | None = None,
+                 backend: str | None = None) -> list[str]:
+    """
+    Chia df thành len(outfiles) trang đều nhau, render lần lượt từng trang ra 1 ảnh (header lặp lại,
+    tiêu đề thêm "(trang i/n)"). Mỗi lần chỉ giữ ảnh của 1 trang -> RAM đỉnh theo số dòng / trang.
+    Trang 1 được ghi sau cùng: thấy outfiles[0] là đủ bộ.
+    Returns:
+        các file đã ghi theo thứ tự trang ([] nếu không có ảnh, vd. bảng rỗng).
+    """
+    n = len(outfiles)
+    if n <= 1:
+        out = render_table(kind, df, outfiles[0], title, backend=backend, preview=previews[0] if previews else None)
+        return [out] if out else []
+    size = -(-len(df) // n)
+    written = {}
+    for i in list(range(1, n)) + [0]:
+        out = render_table(kind, df.iloc[i * size:(i + 1) * size], outfiles[i], f"{title}\n(trang {i + 1}/{n})",
+                           backend=backend, preview=previews[i] if previews else None)
+        if out:
+            written[i] = out
+    return [written[i] for i in sorted(written)]
+# endregion
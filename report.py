@@ -1,61 +1,352 @@
+import os
+import time
+import hashlib
+import threading
+import numpy as np
 import pandas as pd
-from datetime import datetime
-from linebot.v3.messaging import TextMessage, ImageMessage
+from linebot.v3.messaging import TextMessage, ImageMessage, FlexMessage
 from urllib.parse import urljoin
-from utils import df_nhucau_to_image, df_nhapban_to_image, build_flex_text_message
-from cache import load_df_once
+from utils import build_flex_text_message, build_flex_table, ALL_GROUPS
+from renderer import TABLE_RENDERER, OUTPUT_TAG, TABLE_SPECS
+from render_pool import render_pages, RenderError, RENDER_TIMEOUT
+from cache import load_derived_versioned
+from metrics import stage, inc
+import image_store
+
+try:
+    import fcntl  # khoá file giữa các worker (Linux); không có thì chỉ gộp trong process
+except ImportError:
+    fcntl = None
+
+class _PartitionIndex:
+    """
+    Index vị trí dòng theo (siêu thị, ngành hàng) và (siêu thị, nhóm hàng), build 1 lần / version dữ liệu.
+    Tra cứu tốn O(số dòng trả về) thay vì quét cả bảng bằng boolean mask.
+    Lưu dạng mảng đã sắp (vài MB / bảng) thay vì dict 1 mảng / nhóm: mỗi worker gunicorn giữ
+    index riêng nên phải gọn (dữ liệu thì dùng chung, xem cache._read_shared).
+    """
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._by_store_cat = self._build(df["Mã siêu thị"], df["Mã ngành hàng"])
+        self._by_store_group = self._build(df["Mã siêu thị"], df["Mã nhóm hàng"])
+
+    @staticmethod
+    def _build(store: pd.Series, sub: pd.Series):
+        # khoá ghép (siêu thị << 32) + mã ngành/nhóm; mã trống (NA) = -1, không bao giờ được tra tới
+        keys = (store.to_numpy(dtype=np.int64) << 32) + sub.to_numpy(dtype=np.int64, na_value=-1)
+        order = np.argsort(keys, kind="stable").astype(np.int32)  # stable: giữ thứ tự gốc trong nhóm
+        uniq, starts = np.unique(keys[order], return_index=True)
+        return uniq, np.append(starts, len(keys)), order
+
+    @staticmethod
+    def _lookup(index, store_id: int, sub_id) -> np.ndarray:
+        uniq, bounds, order = index
+        if sub_id is None:
+            return order[:0]
+        key = (int(store_id) << 32) + int(sub_id)
+        i = int(np.searchsorted(uniq, key))
+        if i == len(uniq) or uniq[i] != key:
+            return order[:0]
+        return order[bounds[i]:bounds[i + 1]]
+
+    def rows(self, store_id: int, cat_id: int | None = None, group_id: int | None = None) -> pd.DataFrame:
+        """
+        Các dòng của siêu thị store_id (lọc thêm theo ngành/nhóm nếu có), giữ nguyên thứ tự gốc.
+        """
+        if group_id is not None:
+            out = self.df.take(self._lookup(self._by_store_group, store_id, group_id))
+            if cat_id is not None:
+                out = out[out["Mã ngành hàng"] == cat_id]
+            return out
+        return self.df.take(self._lookup(self._by_store_cat, store_id, cat_id))
+
+def _load_index(data_path: str) -> _PartitionIndex:
+    return _load_index_versioned(data_path)[1]
+
+def _load_index_versioned(data_path: str) -> tuple[str, _PartitionIndex]:
+    """(version, index) của cùng 1 snapshot dữ liệu."""
+    return load_derived_versioned(data_path, "partition_index", _PartitionIndex)
+
+def _materialize(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Cột category (cache đọc gọn, xem cache.register_schema) -> object trên bảng đã lọc:
+    ô trống giữ None như dữ liệu gốc, và pickle sang render worker không kèm cả dictionary.
+    """
+    cats = [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+    if not cats:
+        return df
+    df = df.copy(deep=False)
+    for c in cats:
+        df[c] = df[c].astype(object).where(df[c].notna(), None)
+    return df
+
+# region Render cache
+def _image_path(report_id: str, version: str, store_id, cat_id, group: str) -> str:
+    """
+    Tên ảnh định danh theo nội dung: (report, siêu thị, ngành, nhóm, version dữ liệu, backend render,
+    cách mã hoá ảnh). Cùng request + dữ liệu chưa đổi -> cùng file; parquet đổi -> version đổi -> file mới.
+    Trang sau / ảnh preview đi kèm: image_store.page_path(...) / image_store.preview_path(...).
+    """
+    key = f"{report_id}|{store_id}|{cat_id}|{group}|{version}|{TABLE_RENDERER}|{OUTPUT_TAG}|{PAGE_ROWS}x{MAX_PAGES}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return image_store.image_path(f"table_{report_id}_{store_id}_{digest}.png")
+
+class _SingleFlight:
+    """
+    Gộp các lời gọi cùng khoá đang chạy đồng thời trong process: thread đầu tiên (leader) chạy fn,
+    các thread đến sau chờ rồi dùng chung kết quả (hoặc exception) của nó thay vì chạy lại.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict = {}  # key -> [Event, kết quả, exception]
+
+    def do(self, key, fn) -> tuple[object, bool]:
+        """Returns: (kết quả, shared) với shared=True nếu kết quả là của thread khác."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None]
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1], True
+        try:
+            call[1] = fn()
+        except BaseException as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+        return call[1], False
+
+_FLIGHTS = _SingleFlight()
+REPORTS_HELP = "Số báo cáo theo report + kết quả (flex/cache_hit/coalesced/rendered/empty/busy)"
+# khoá render giữa các worker gunicorn: băm tên ảnh vào RENDER_LOCK_SLOTS file khoá dùng lại mãi
+# (không tạo / xoá 1 file khoá mỗi ảnh); 2 ảnh khác nhau trùng slot chỉ phải render lần lượt
+RENDER_LOCK_DIR = os.getenv("RENDER_LOCK_DIR", "/dev/shm/linebot-render" if os.path.isdir("/dev/shm") else "")
+RENDER_LOCK_SLOTS = 256
+
+class _RenderLock:
+    """flock theo slot của out_path, chờ tối đa timeout giây (quá hạn thì render luôn, không khoá)."""
+    def __init__(self, out_path: str, timeout: float):
+        self.file = None
+        if fcntl is None or not RENDER_LOCK_DIR:
+            return
+        slot = int(hashlib.sha1(out_path.encode("utf-8")).hexdigest()[:8], 16) % RENDER_LOCK_SLOTS
+        try:
+            os.makedirs(RENDER_LOCK_DIR, exist_ok=True)
+            self.file = open(os.path.join(RENDER_LOCK_DIR, f"slot-{slot:03d}.lock"), "w")
+        except OSError as e:
+            print(f"[render-lock][ERROR] {e}")
+            return
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    print(f"[render-lock] chờ quá {timeout}s -> render không khoá {out_path}")
+                    self.file.close()
+                    self.file = None
+                    return
+                time.sleep(0.05)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.file is not None:
+            self.file.close()  # đóng file = nhả flock
+
+def _cached_pages(out_path: str) -> list[str]:
+    """Các trang ảnh nếu đã render đủ (kể cả preview), [] nếu chưa."""
+    pages = image_store.pages(out_path)
+    previews = [image_store.preview_path(p) for p in pages]
+    if pages and all(os.path.exists(p) for p in previews):
+        image_store.touch(*pages, *previews)  # gia hạn TTL, tránh bị dọn khi vẫn còn được xem
+        return pages
+    return []
+
+def _render_once(report_id: str, out_path: str, prepare, render, table=None,
+                 source: str | None = None) -> tuple[str, list[str] | FlexMessage]:
+    """
+    Chỉ lọc dữ liệu + render khi ảnh out_path (hoặc preview của nó) chưa có (renderer tự ghi nguyên tử):
+    data = prepare(); table(data) ra FlexMessage thì trả luôn bảng Flex, không thì render(data, outfile).
+    Request trùng (cùng out_path = report, siêu thị, ngành, nhóm, version dữ liệu) đến cùng lúc chỉ lọc +
+    render 1 lần: trong process qua _FLIGHTS (kể cả bảng Flex), giữa các worker qua _RenderLock
+    (worker sau thấy ảnh có sẵn).
+    Returns:
+        ("flex", FlexMessage) hoặc (outcome, các trang ảnh) với outcome: "cache_hit" / "rendered" /
+        "empty" (bảng rỗng, không có ảnh) / "busy" (render quá hạn / worker render lỗi - RenderError).
+    """
+    pages = _cached_pages(out_path)
+    if pages:
+        print(f"[render-cache] HIT {out_path} ({len(pages)} trang)")
+        inc("linebot_reports_total", help=REPORTS_HELP, report=report_id, outcome="cache_hit", source=source)
+        return "cache_hit", pages
+
+    def leader():
+        data = prepare()
+        flex = table(data) if table else None
+        if flex is not None:
+            return "flex", flex
+        with _RenderLock(out_path, timeout=RENDER_TIMEOUT):
+            pages = _cached_pages(out_path)  # worker / request khác vừa render xong trong lúc chờ
+            if pages:
+                return "cache_hit", pages
+            try:
+                pages = render(data, out_path)
+                return ("rendered" if pages else "empty"), pages or []
+            except RenderError as e:
+                print(f"[render][ERROR] {out_path}: {e}")
+                return "busy", []
+
+    (outcome, result), shared = _FLIGHTS.do(out_path, leader)
+    if shared:
+        print(f"[render-cache] COALESCED {out_path} -> {outcome}")
+    inc("linebot_reports_total", help=REPORTS_HELP, report=report_id,
+        outcome="coalesced" if shared else outcome, source=source)
+    return outcome, result
+
+def _render_paged(kind: str, df: pd.DataFrame, outfile: str, title: str) -> list[str]:
+    """
+    Render bảng thành các trang tối đa PAGE_ROWS dòng (trang 1 = outfile), tối đa MAX_PAGES trang:
+    mỗi trang luôn giới hạn chiều cao / RAM render; bảng dài hơn MAX_PAGES * PAGE_ROWS dòng thì cắt bớt,
+    tiêu đề ghi rõ số dòng không hiển thị.
+    """
+    hidden = len(df) - MAX_PAGES * PAGE_ROWS
+    if hidden > 0:
+        df = df.iloc[:MAX_PAGES * PAGE_ROWS]
+        title = f"{title}\n(… còn {hidden} dòng không hiển thị)"
+    n = max(1, -(-len(df) // PAGE_ROWS))
+    outfiles = [image_store.page_path(outfile, i) for i in range(1, n + 1)]
+    return render_pages(kind, df, outfiles, title, previews=[image_store.preview_path(p) for p in outfiles])
+
+RENDER_BUSY_TEXT = "⏳ Hệ thống đang bận tạo báo cáo, vui lòng thử lại sau ít phút!"
+NO_DATA_TEXT = "Không có dữ liệu cho lựa chọn này."
+# số dòng / trang ảnh: ảnh nhỏ đọc được trên điện thoại + RAM render có giới hạn
+PAGE_ROWS = int(os.getenv("REPORT_PAGE_ROWS", "40"))
+# LINE cho tối đa 5 message / reply: 1 dòng tiêu đề + tối đa 4 trang ảnh
+MAX_PAGES = 4
+# kết quả <= bấy nhiêu dòng -> gửi bảng Flex (chữ, không cần render / tải ảnh); 0 = luôn dùng ảnh.
+# Bảng quá FLEX_TABLE_MAX_BYTES (utils) vẫn chuyển sang ảnh
+FLEX_TABLE_ROWS = int(os.getenv("FLEX_TABLE_ROWS", "15"))
+# endregion
+
+def _group_label(cat_name: str, group: str) -> str:
+    return f"Ngành hàng {cat_name}" if group == ALL_GROUPS else f"Nhóm hàng {group}"
+
+def _prepare_thongtinchiahang(idx: _PartitionIndex, store_id, cat_id, cat_name: str, group: str) -> tuple[pd.DataFrame, str]:
+    """Bảng thông tin chia hàng đã lọc từ idx + tiêu đề (dùng chung cho ảnh và bảng Flex)."""
+    ngay_cap_nhat = idx.df['Ngày cập nhật'].iloc[0]
+
+    with stage("filter", report="thongtinchiahang"):
+        if group == ALL_GROUPS:
+            df = idx.rows(int(store_id), cat_id=int(cat_id))
+        else:
+            df = idx.rows(int(store_id), cat_id=int(cat_id), group_id=int(group.split("-", 1)[0]))
+
+        df = _materialize(df[["Tên siêu thị","Tên sản phẩm","Min chia","Số chia","Trạng thái"]])
+        ten_sieu_thi = df['Tên siêu thị'].iloc[0] if not df.empty else "N/A"
+        df = df.drop(columns=["Tên siêu thị"])
+    return df, f"Thông tin chia hàng của siêu thị {store_id}-{ten_sieu_thi}\n{_group_label(cat_name, group)}\n(ngày cập nhật: {ngay_cap_nhat})"
+
+def _prepare_ketquabanhang(idx: _PartitionIndex, store_id, cat_id, cat_name: str, group: str) -> tuple[pd.DataFrame, str]:
+    """Bảng kết quả bán hàng đã lọc từ idx + tiêu đề (dùng chung cho ảnh và bảng Flex)."""
+    tu_ngay = idx.df['Từ ngày'].iloc[0]
+    den_ngay = idx.df['Đến ngày'].iloc[0]
+
+    with stage("filter", report="ketquabanhang"):
+        if group == ALL_GROUPS:
+            df = idx.rows(int(store_id), cat_id=int(cat_id))
+        else:
+            df = idx.rows(int(store_id), group_id=int(group.split("-", 1)[0]))
+
+        # rename sau khi lọc để không copy cả bảng gốc
+        df = df.rename(columns={'Trạng thái':'Số chia hiện tại'})
+        df = _materialize(df[["Tên siêu thị","Nhóm sản phẩm","Nhu cầu","PO","Nhập","Bán","% Nhập/PO","% Bán/Nhập","Số chia hiện tại"]])
+        df = df.sort_values(by=["Nhập","Số chia hiện tại"], ascending=False)
+        df = df.drop_duplicates(subset=["Nhóm sản phẩm"], keep="first")
+        ten_sieu_thi = df['Tên siêu thị'].iloc[0] if not df.empty else "N/A"
+        df = df.drop(columns=["Tên siêu thị"])
+    return df, f"Báo cáo kết quả bán hàng của siêu thị {store_id}-{ten_sieu_thi}\n{_group_label(cat_name, group)}\n(đơn vị KG) (dữ liệu từ {tu_ngay} đến {den_ngay})"
+
+# report -> (hàm lọc, kiểu bảng trong renderer.TABLE_SPECS, tiêu đề ngắn)
+_REPORTS = {
+    "thongtinchiahang": (_prepare_thongtinchiahang, "nhucau",  "Thông tin chia hàng"),
+    "ketquabanhang":    (_prepare_ketquabanhang,    "nhapban", "Kết quả bán hàng"),
+}
+
+def _build_report(report_id: str, data_path: str, store_id, cat_id, cat_name: str, group: str,
+                  source: str | None = None) -> tuple[str, list[str] | FlexMessage]:
+    """
+    Kết quả ít dòng (<= FLEX_TABLE_ROWS, JSON vừa 1 bubble) -> trả thẳng bảng Flex, không render ảnh;
+    còn lại -> ảnh (render nếu chưa có). Ảnh đã có sẵn thì dùng luôn, không lọc lại dữ liệu.
+    Lọc + chọn Flex / ảnh chạy trong _render_once -> request trùng đến cùng lúc dùng chung 1 lần.
+    Returns:
+        ("flex", FlexMessage) hoặc (outcome, các trang ảnh) như _render_once.
+    """
+    prepare, kind, label = _REPORTS[report_id]
+
+    def table(prepared):
+        df, title = prepared
+        if not 0 < len(df) <= FLEX_TABLE_ROWS:
+            return None
+        with stage("flex_table", report=report_id):
+            return build_flex_table(df, title, TABLE_SPECS[kind], alt_text=f"{label} - ST: {store_id}")
+
+    def render(prepared, outfile):
+        df, title = prepared
+        with stage("render", report=report_id):
+            return _render_paged(kind, df, outfile, title=title)
+
+    # tên ảnh (theo version) và dữ liệu lọc lấy từ cùng 1 snapshot: reloader swap giữa chừng không thể
+    # ghi dữ liệu mới vào tên ảnh của version cũ
+    with stage("load", report=report_id):
+        version, idx = _load_index_versioned(data_path)
+    out_path = _image_path(report_id, version, store_id, cat_id, group)
+    return _render_once(report_id, out_path, lambda: prepare(idx, store_id, cat_id, cat_name, group),
+                        render, table=table, source=source)
+
+def prerender(report_id: str, data_path: str, store_id, cat_id, cat_name: str, group: str) -> str:
+    """
+    Render trước ảnh của 1 báo cáo vào đúng file request sẽ dùng (xem prerender.py).
+    Returns:
+        outcome như _render_once ("cache_hit" nếu ảnh đã có, "flex" nếu báo cáo đủ nhỏ để không cần ảnh).
+    """
+    return _build_report(report_id, data_path, store_id, cat_id, cat_name, group, source="prerender")[0]
+
+def _image_messages(public_base_url: str, pages: list[str]) -> list:
+    """1 ImageMessage / trang (ảnh gốc + preview thu nhỏ); bảng rỗng (không có ảnh) -> báo không có dữ liệu."""
+    if not pages:
+        return [TextMessage(text=NO_DATA_TEXT)]
+    base = public_base_url + "/"
+    return [ImageMessage(original_content_url=urljoin(base, image_store.url_path(p)),
+                         preview_image_url=urljoin(base, image_store.url_path(image_store.preview_path(p))))
+            for p in pages]
 
 def report_thongtinchiahang(data_path: str, public_base_url: str, store_id: str, cat_id: str, cat_name: str, group: str):
     messages = []
-    df = load_df_once(data_path)
-    ngay_cap_nhat = df['Ngày cập nhật'].iloc[0]
-
-    df = df[df['Mã ngành hàng'] == int(cat_id)]
-    if group == "Xem tất cả nhóm": pass
-    else: df = df[df['Mã nhóm hàng'] == int(group.split("-", 1)[0])]
-
-    df = df[df["Mã siêu thị"] == int(store_id)][["Tên siêu thị","Tên sản phẩm","Min chia","Số chia","Trạng thái"]]
-    ten_sieu_thi = df['Tên siêu thị'].iloc[0] if not df.empty else "N/A"
-    df = df.drop(columns=["Tên siêu thị"])
-    
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"table_thongtinchiahang_{store_id}_{ts}.png"
-    out_path = f"static/{filename}"
-    group_label = f"Ngành hàng {cat_name}" if group == "Xem tất cả nhóm" else f"Nhóm hàng {group}"
-    df_nhucau_to_image(df, outfile=out_path, title=f"Thông tin chia hàng của siêu thị {store_id}-{ten_sieu_thi}\n{group_label}\n(ngày cập nhật: {ngay_cap_nhat})")
-
-    img_url = urljoin(public_base_url + "/", out_path)
-    text = f"Thông tin chia hàng - ST: {store_id}\n{group_label}"
+    outcome, result = _build_report("thongtinchiahang", data_path, store_id, cat_id, cat_name, group)
+    if outcome == "busy":
+        return [TextMessage(text=RENDER_BUSY_TEXT)]
+
+    text = f"Thông tin chia hàng - ST: {store_id}\n{_group_label(cat_name, group)}"
     messages.append(build_flex_text_message(text, bg="#FFFFFF", fg="#000000", size="md", weight="regular"))
-    messages.append(ImageMessage(original_content_url=img_url, preview_image_url=img_url))
+    messages.extend([result] if outcome == "flex" else _image_messages(public_base_url, result))
     return messages
 
 def report_ketquabanhang(data_path: str, public_base_url: str, store_id: str, cat_id: str, cat_name: str, group: str):
     messages = []
-    df = load_df_once(data_path)
-    df = df.rename(columns={'Trạng thái':'Số chia hiện tại'})
-    tu_ngay = df['Từ ngày'].iloc[0]
-    den_ngay = df['Đến ngày'].iloc[0]
-
-    if group == "Xem tất cả nhóm":
-        df = df[df['Mã ngành hàng'] == int(cat_id)]
-    else:
-        df = df[df['Mã nhóm hàng'] == int(group.split("-", 1)[0])]
-
-    df = df[df["Mã siêu thị"] == int(store_id)][["Tên siêu thị","Nhóm sản phẩm","Nhu cầu","PO","Nhập","Bán","% Nhập/PO","% Bán/Nhập","Số chia hiện tại"]]
-    df = df.sort_values(by=["Nhập","Số chia hiện tại"], ascending=False)
-    df = df.drop_duplicates(subset=["Nhóm sản phẩm"], keep="first")
-    ten_sieu_thi = df['Tên siêu thị'].iloc[0] if not df.empty else "N/A"
-    df = df.drop(columns=["Tên siêu thị"])
-    
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"table_ketquabanhang_{store_id}_{ts}.png"
-    out_path = f"static/{filename}"
-    group_label = f"Ngành hàng {cat_name}" if group == "Xem tất cả nhóm" else f"Nhóm hàng {group}"
-    df_nhapban_to_image(df, outfile=out_path, title=f"Báo cáo kết quả bán hàng của siêu thị {store_id}-{ten_sieu_thi}\n{group_label}\n(đơn vị KG) (dữ liệu từ {tu_ngay} đến {den_ngay})")
-
-    img_url = urljoin(public_base_url + "/", out_path)
-    messages.append(build_flex_text_message(f"Kết quả bán hàng - ST: {store_id}\n{group_label}", bg="#FFFFFF", fg="#000000", size="md", weight="regular"))
-    messages.append(ImageMessage(original_content_url=img_url, preview_image_url=img_url))
-    return messages
+    outcome, result = _build_report("ketquabanhang", data_path, store_id, cat_id, cat_name, group)
+    if outcome == "busy":
+        return [TextMessage(text=RENDER_BUSY_TEXT)]
 
+    messages.append(build_flex_text_message(f"Kết quả bán hàng - ST: {store_id}\n{_group_label(cat_name, group)}", bg="#FFFFFF", fg="#000000", size="md", weight="regular"))
+    messages.extend([result] if outcome == "flex" else _image_messages(public_base_url, result))
+    return messages
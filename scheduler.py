@@ -1,14 +1,19 @@
 import os
+import re
+import time
+import sqlite3
+import threading
+from contextlib import closing
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 import pandas as pd
 from apscheduler.schedulers.background import BackgroundScheduler
-from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi, PushMessageRequest, TextMessage
-)
+from linebot.v3.messaging import PushMessageRequest, MulticastRequest, TextMessage, ApiException
+import line_client
+import prerender
 # from dotenv import load_dotenv
 # load_dotenv()
-CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
 
 # ====== CẤU HÌNH CƠ BẢN ======
 THOI_GIAN_GUI_TIN_NHAN = [
@@ -17,66 +22,226 @@ THOI_GIAN_GUI_TIN_NHAN = [
 ]
 
 XLSX_PATH  = os.getenv("SCHEDULE_XLSX", "./data/schedule.xlsx")
+SCHEDULE_DB = os.getenv("SCHEDULE_DB", os.path.splitext(XLSX_PATH)[0] + ".sqlite")
 TZ_NAME = os.getenv("TZ", "Asia/Ho_Chi_Minh")
 TZ = pytz.timezone(TZ_NAME)
 
+# ====== GỬI HÀNG LOẠT ======
+MULTICAST_LIMIT = 500                                             # số người nhận tối đa / 1 request multicast của LINE
+SEND_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "4"))   # số request gửi song song
+SEND_RATE = float(os.getenv("SCHEDULER_RATE", "50"))              # request/giây (token bucket)
+SEND_BURST = int(os.getenv("SCHEDULER_BURST", "10"))
+RETRY_429_SECONDS = 2.0
+# 1 id sai trong multicast -> LINE trả 400 cho cả request (mất cả lô) -> lọc trước khi gom lô
+USER_ID_RE = re.compile(r"^U[0-9a-f]{32}$")
+
+# ====== RENDER TRƯỚC BÁO CÁO ======
+# chạy trước giờ gửi tin đầu tiên để người xem sớm nhất không gặp ảnh chưa render (xem prerender.py)
+PRERENDER_AT = os.getenv("PRERENDER_AT", "05:00")
+
 # ====== LINE PUSH ======
 def _push_text(user_id: str, text: str):
-    cfg = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
-    with ApiClient(cfg) as c:
-        MessagingApi(c).push_message(
-            PushMessageRequest(to=user_id, messages=[TextMessage(text=text)])
-        )
+    # client dùng chung (giữ kết nối keep-alive), không tạo ApiClient mới mỗi người nhận
+    line_client.push_message(
+        PushMessageRequest(to=user_id, messages=[TextMessage(text=text)])
+    )
 
-# ====== ĐỌC EXCEL & LỌC HÔM NAY ======
-def _read_rows_for_today() -> pd.DataFrame:
+def _multicast_text(user_ids: list[str], text: str):
+    line_client.multicast(
+        MulticastRequest(to=user_ids, messages=[TextMessage(text=text)])
+    )
+
+class _TokenBucket:
+    """Giới hạn tốc độ gọi API: tối đa `rate` request/giây, cho phép dồn `burst` request."""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Chờ tới khi có token. Trả True nếu phải chờ (bị throttle)."""
+        waited = False
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            waited = True
+            time.sleep(wait)
+
+# ====== SCHEDULE STORE (SQLite, index theo ngày gửi) ======
+# Excel chỉ được import lại khi file đổi (mtime/size); mỗi slot chỉ là 1 truy vấn theo index ngày.
+_STORE_LOCK = threading.Lock()
+
+def _xlsx_version() -> str | None:
+    try:
+        st = os.stat(XLSX_PATH)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+def _store_version() -> str | None:
+    if not os.path.exists(SCHEDULE_DB):
+        return None
     try:
-        df = pd.read_excel(XLSX_PATH, engine="openpyxl", dtype=str)
-    except Exception as e:
-        print(f"[scheduler] read_excel error: {e}")
-        return pd.DataFrame(columns=["user_id", "ngay_gui_tin_nhan", "noi_dung"])
+        # context manager của sqlite3 chỉ commit/rollback, không đóng kết nối -> closing()
+        with closing(sqlite3.connect(SCHEDULE_DB)) as con:
+            row = con.execute("SELECT value FROM meta WHERE key = 'source_version'").fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+def _parse_dates(s: pd.Series) -> pd.Series:
+    """
+    Parse ngày linh hoạt (yyyy-mm-dd, dd/mm/yyyy, ...) -> 'YYYY-MM-DD' hoặc None.
+    Chỉ parse mỗi chuỗi khác nhau 1 lần rồi map lại (cả file thường chỉ vài chục ngày).
+    """
+    uniq = pd.Series(s.unique())
+    parsed = pd.to_datetime(uniq, dayfirst=True, errors="coerce")
+    lookup = dict(zip(uniq, parsed.dt.strftime("%Y-%m-%d").where(parsed.notna(), None)))
+    return s.map(lookup)
+
+def _rebuild_store(version: str) -> None:
+    """Đọc schedule.xlsx -> ghi SQLite mới ra file tạm rồi os.replace (không bao giờ đọc phải DB dở)."""
+    t0 = time.monotonic()
+    df = pd.read_excel(XLSX_PATH, engine="openpyxl", dtype=str)
 
     # Chuẩn hoá cột bắt buộc
     for col in ["user_id", "ngay_gui_tin_nhan", "noi_dung"]:
         if col not in df.columns:
             df[col] = ""
         df[col] = df[col].fillna("").astype(str).str.strip()
+    df["send_date"] = _parse_dates(df["ngay_gui_tin_nhan"])
+    df = df[df["send_date"].notna()]
 
-    # Parse ngày linh hoạt: hỗ trợ yyyy-mm-dd, dd/mm/yyyy, v.v.
-    # Chuyển về date (không kèm giờ) để so sánh với "hôm nay" theo TZ
-    def to_date_safe(s):
-        try:
-            dt = pd.to_datetime(s, dayfirst=True, errors="coerce")
-            if pd.isna(dt):
-                return None
-            return dt.date()
-        except Exception:
-            return None
+    tmp = f"{SCHEDULE_DB}.{os.getpid()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with closing(sqlite3.connect(tmp)) as con, con:
+        con.execute("CREATE TABLE schedule (send_date TEXT NOT NULL, user_id TEXT NOT NULL, noi_dung TEXT NOT NULL)")
+        con.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        con.executemany(
+            "INSERT INTO schedule (send_date, user_id, noi_dung) VALUES (?, ?, ?)",
+            df[["send_date", "user_id", "noi_dung"]].itertuples(index=False, name=None),
+        )
+        con.execute("CREATE INDEX idx_schedule_send_date ON schedule (send_date)")
+        con.execute("INSERT INTO meta (key, value) VALUES ('source_version', ?)", (version,))
+    os.replace(tmp, SCHEDULE_DB)
+    print(f"[scheduler] imported {len(df)} row(s) from {XLSX_PATH} in {time.monotonic() - t0:.2f}s")
 
-    df["_ngay"] = df["ngay_gui_tin_nhan"].map(to_date_safe)
-    today = datetime.now(TZ).date()
+def _ensure_store() -> bool:
+    """Import lại Excel nếu file đổi. Trả False nếu không có dữ liệu nào để đọc."""
+    with _STORE_LOCK:
+        version = _xlsx_version()
+        if version is None:
+            print(f"[scheduler] không đọc được {XLSX_PATH}")
+            return os.path.exists(SCHEDULE_DB)  # vẫn dùng bản import gần nhất nếu có
+        if _store_version() != version:
+            try:
+                _rebuild_store(version)
+            except Exception as e:
+                print(f"[scheduler] read_excel error: {e}")
+                return os.path.exists(SCHEDULE_DB)
+        return True
 
-    today_df = df[df["_ngay"] == today][["user_id", "noi_dung"]].copy()
+# ====== LỌC HÔM NAY ======
+def _read_rows_for_today() -> pd.DataFrame:
+    if not _ensure_store():
+        return pd.DataFrame(columns=["user_id", "noi_dung"])
+    # So sánh với "hôm nay" theo TZ
+    today = datetime.now(TZ).date().isoformat()
+    with closing(sqlite3.connect(SCHEDULE_DB)) as con:
+        today_df = pd.read_sql_query(
+            "SELECT user_id, noi_dung FROM schedule WHERE send_date = ?", con, params=(today,)
+        )
     return today_df
 
 # ====== JOB CHẠY MỖI LẦN ĐẾN SLOT ======
+def _build_batches(rows: pd.DataFrame) -> list[tuple[str, list[str]]]:
+    """
+    Gom người nhận theo nội dung giống nhau -> [(noi_dung, [user_id,... <= MULTICAST_LIMIT])].
+    Bỏ dòng thiếu user_id/noi_dung hoặc user_id sai định dạng; 1 người nhận trùng nội dung chỉ gửi 1 lần.
+    """
+    rows = rows[(rows["user_id"] != "") & (rows["noi_dung"] != "")]
+    valid = rows["user_id"].str.match(USER_ID_RE)
+    if not valid.all():
+        bad = rows.loc[~valid, "user_id"].unique()
+        print(f"[scheduler] bỏ {int((~valid).sum())} dòng có user_id sai định dạng: "
+              f"{', '.join(map(repr, bad[:10]))}{' ...' if len(bad) > 10 else ''}")
+        rows = rows[valid]
+    batches = []
+    for msg, uids in rows.groupby("noi_dung", sort=False)["user_id"]:
+        uids = list(dict.fromkeys(uids))
+        for i in range(0, len(uids), MULTICAST_LIMIT):
+            batches.append((msg, uids[i:i + MULTICAST_LIMIT]))
+    return batches
+
+def _call_api(send, bucket: _TokenBucket, target: str) -> tuple[bool, int, int | None]:
+    """Gọi send() qua token bucket, 429 thì chờ rồi thử lại 1 lần. Returns: (ok, số lần bị throttle, HTTP status lỗi)."""
+    throttled = 0
+    for attempt in range(2):
+        if bucket.acquire():
+            throttled += 1
+        try:
+            send()
+            return True, throttled, None
+        except ApiException as e:
+            if e.status == 429 and attempt == 0:
+                # LINE báo vượt rate limit -> chờ rồi thử lại 1 lần
+                throttled += 1
+                time.sleep(RETRY_429_SECONDS)
+                continue
+            print(f"[scheduler][send][ERROR] to={target} status={e.status} err={e.reason}")
+            return False, throttled, e.status
+        except Exception as e:
+            print(f"[scheduler][send][ERROR] to={target} err={e}")
+            return False, throttled, None
+    return False, throttled, 429
+
+def _send_batch(msg: str, uids: list[str], bucket: _TokenBucket, stats: dict, lock: threading.Lock):
+    if len(uids) == 1:
+        ok, throttled, status = _call_api(lambda: _push_text(uids[0], msg), bucket, uids[0])
+    else:
+        ok, throttled, status = _call_api(lambda: _multicast_text(uids, msg), bucket, f"{len(uids)} user(s)")
+    sent, requests = (len(uids) if ok else 0), 1
+    if status == 400 and len(uids) > 1:
+        # 400 cho cả lô (vd. 1 người nhận không hợp lệ) -> push từng người, ai lỗi thì chỉ người đó lỗi
+        print(f"[scheduler] multicast 400 -> push từng người ({len(uids)} user(s))")
+        for uid in uids:
+            ok, t, _ = _call_api(lambda: _push_text(uid, msg), bucket, uid)
+            sent += ok
+            throttled += t
+            requests += 1
+    with lock:
+        stats["sent"] += sent
+        stats["failed"] += len(uids) - sent
+        stats["throttled"] += throttled
+        stats["requests"] += requests
+
 def _send_for_current_slot():
     rows = _read_rows_for_today()
     if rows.empty:
         print("[scheduler] today: nothing to send")
         return
-    sent = 0
-    for _, r in rows.iterrows():
-        uid = r["user_id"]
-        msg = r["noi_dung"]
-        if not uid or not msg:
-            continue
-        try:
-            _push_text(uid, msg)
-            sent += 1
-        except Exception as e:
-            print(f"[scheduler][push][ERROR] to={uid} err={e}")
-    print(f"[scheduler] sent {sent} message(s) for current slot")
+    t0 = time.monotonic()
+    batches = _build_batches(rows)
+    stats = {"sent": 0, "failed": 0, "throttled": 0, "requests": 0}
+    lock = threading.Lock()
+    bucket = _TokenBucket(SEND_RATE, SEND_BURST)
+    # mỗi nội dung khác nhau gửi song song, giới hạn SEND_CONCURRENCY luồng + token bucket
+    with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY, thread_name_prefix="sched-send") as ex:
+        for msg, uids in batches:
+            ex.submit(_send_batch, msg, uids, bucket, stats, lock)
+    print(f"[scheduler] slot done in {time.monotonic() - t0:.1f}s: "
+          f"sent={stats['sent']} failed={stats['failed']} throttled={stats['throttled']} "
+          f"requests={stats['requests']}")
+    return stats
 
 # ====== KHỞI TẠO SCHEDULER ======
 def init_scheduler():
@@ -106,4 +271,13 @@ def init_scheduler():
         )
         print(f"[scheduler] start cron @ {h:02d}:{m:02d} (TZ={TZ_NAME}) id={job_id}")
 
+    if PRERENDER_AT and prerender.PRERENDER_TOP > 0:
+        try:
+            h, m = (int(x) for x in PRERENDER_AT.split(":", 1))
+            sch.add_job(prerender.run, trigger="cron", hour=h, minute=m, id="prerender_reports",
+                        replace_existing=True, max_instances=1, coalesce=True)
+            print(f"[scheduler] start prerender cron @ {h:02d}:{m:02d} (TZ={TZ_NAME})")
+        except ValueError as e:
+            print(f"[scheduler] skip invalid PRERENDER_AT={PRERENDER_AT!r}: {e}")
+
     return sch
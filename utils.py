@@ -1,10 +1,14 @@
+import json
 import numpy as np
 import pandas as pd
 import matplotlib, os
+import threading
+from collections import OrderedDict
 from linebot.v3.messaging import FlexMessage, FlexContainer
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-from cache import load_df_once
+from cache import load_derived
+from renderer import highlight_mask, TABLE_SPECS, HEADER_BG, HEADER_FG, STRIPE_BG, HIGHLIGHT_BG
 
 def build_flex_categories(
     store_id: int,
@@ -213,6 +217,93 @@ def build_flex_text_message(
         contents=FlexContainer.from_dict(flex)
     )
 
+# giới hạn JSON 1 bubble của LINE là 30KB, chừa phần cho header / altText
+FLEX_TABLE_MAX_BYTES = int(os.getenv("FLEX_TABLE_MAX_BYTES", "25000"))
+
+def build_flex_table(df: pd.DataFrame, title: str, spec: dict, alt_text: str) -> FlexMessage | None:
+    """
+    Bảng nhỏ dạng Flex bubble (không cần render ảnh): cùng bố cục + quy tắc tô màu với ảnh
+    (renderer): header xanh chữ trắng, sọc ngựa vằn, ô highlight_col < highlight_below nền đỏ nhạt.
+    spec: TABLE_SPECS[kind] (tỉ lệ cột -> flex của từng ô).
+    Returns:
+        None nếu JSON bubble vượt FLEX_TABLE_MAX_BYTES (bên gọi dùng ảnh thay thế).
+    """
+    columns = list(df.columns)
+    widths = (list(spec["col_widths"]) + [spec["col_widths"][-1]] * len(columns))[:len(columns)]
+    flex = [max(1, round(w * 100)) for w in widths]
+    size = "xxs" if len(columns) > 5 else "xs"
+    hl = highlight_mask(df, spec)
+    hl_c = columns.index(spec["highlight_col"]) if hl.any() else None
+
+    def cell(value, c, bg=None, **style):
+        text = "-" if pd.isna(value) or value == "" else str(value)  # ô trống: Flex không nhận text rỗng
+        box = {"type": "box", "layout": "vertical", "flex": flex[c], "paddingAll": "xs",
+               "contents": [{"type": "text", "text": text, "size": size, "wrap": True, **style}]}
+        if bg:
+            box["backgroundColor"] = bg
+        return box
+
+    rows = [{"type": "box", "layout": "horizontal", "backgroundColor": HEADER_BG,
+             "contents": [cell(name, c, weight="bold", color=HEADER_FG, align="center") for c, name in enumerate(columns)]}]
+    for r, values in enumerate(df.itertuples(index=False, name=None)):
+        rows.append({"type": "box", "layout": "horizontal", "backgroundColor": STRIPE_BG[r % 2],
+                     "contents": [cell(v, c, bg=HIGHLIGHT_BG if c == hl_c and hl[r] else None)
+                                  for c, v in enumerate(values)]})
+
+    bubble = {
+        "type": "bubble",
+        "size": "giga",
+        "header": {
+            "type": "box", "layout": "vertical", "paddingAll": "md",
+            "contents": [{"type": "text", "text": line, "weight": "bold", "size": "sm", "align": "center", "wrap": True}
+                         for line in str(title).split("\n")],
+        },
+        "body": {"type": "box", "layout": "vertical", "spacing": "none", "paddingAll": "sm",
+                 "borderWidth": "light", "borderColor": "#000000", "contents": rows},
+    }
+    if len(json.dumps(bubble, ensure_ascii=False).encode("utf-8")) > FLEX_TABLE_MAX_BYTES:
+        return None
+    return FlexMessage(altText=alt_text, contents=FlexContainer.from_dict(bubble))
+
+class FlexCache:
+    """
+    LRU cache các FlexMessage đã build + validate sẵn (dict -> FlexContainer.from_dict tốn kém).
+    Entry gắn version dữ liệu: version đổi -> mọi entry của version cũ bị bỏ.
+    """
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build, version=None):
+        """
+        Trả FlexMessage theo key; chưa có (hoặc khác version) thì gọi build() rồi lưu.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == version:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        msg = build()  # build ngoài lock để request khác không phải chờ
+        with self._lock:
+            self.misses += 1
+            if version is not None:
+                stale = [k for k, (v, _) in self._data.items() if v is not None and v != version]
+                for k in stale:
+                    del self._data[k]
+            self._data[key] = (version, msg)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return msg
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
 def df_nhucau_to_image(df, outfile="static/table.png", title="Kết quả"):
     fig_h = len(df) * 0.2 + 1
     fig, ax = plt.subplots(figsize=(9, fig_h))
@@ -269,6 +360,8 @@ def df_nhapban_to_image(df, outfile="static/table.png", title="Kết quả"):
         tbl.set_fontsize(10)
         tbl.scale(1.05, 1.15)
 
+        # parse cột "% Bán/Nhập" 1 lần thay vì df.iloc từng ô
+        low = highlight_mask(df, TABLE_SPECS["nhapban"])
         for (r, c), cell in tbl.get_celld().items():
             if r == 0:
                 cell.set_facecolor("#4CAF50")
@@ -278,15 +371,8 @@ def df_nhapban_to_image(df, outfile="static/table.png", title="Kết quả"):
                 cell.set_facecolor("#f5f5f5" if r % 2 == 0 else "#ffffff")
                 cell.set_height(0.35 / fig_h)
 
-                col_name = df.columns[c]
-                if col_name == "% Bán/Nhập":
-                    raw_val = str(df.iloc[r-1, c])
-                    try:
-                        num_val = float(raw_val.strip().replace("%", "")) / 100
-                        if num_val < 0.8:
-                            cell.set_facecolor("#ffb2b2")  # nền đỏ nhạt
-                    except Exception:
-                        pass
+                if df.columns[c] == "% Bán/Nhập" and low[r-1]:
+                    cell.set_facecolor("#ffb2b2")  # nền đỏ nhạt
 
         os.makedirs(os.path.dirname(outfile), exist_ok=True)
         plt.savefig(outfile, dpi=200, bbox_inches="tight", pad_inches=0.2)
@@ -306,45 +392,210 @@ def _haversine_km(lat1, lon1, lats2, lons2):
     return 2*_R_EARTH_KM*np.arcsin(np.sqrt(a))
 
 class StoreLocator:
-    def __init__(self, path="data/location.parquet"):
-        df = pd.read_parquet(path)
+    """
+    Tìm siêu thị gần nhất theo toạ độ.
+    Index lưới (ô GRID_DEG độ, build 1 lần trong __init__): chỉ tính haversine cho các ô giao
+    bounding box bán kính tìm kiếm thay vì mọi siêu thị. Kết quả giống hệt quét toàn bộ
+    (_nearest_scan): cùng công thức khoảng cách, sắp theo (khoảng cách, thứ tự dòng).
+    """
+    GRID_DEG = 0.05      # ~5.5km / ô
+    SEARCH_KM = 5.0      # bán kính bắt đầu khi không giới hạn max_km (mỗi lần thiếu thì x4)
+    BATCH_CELLS = 2_000_000  # số ô ma trận khoảng cách / lượt trong nearest_many
+
+    def __init__(self, path="data/location.parquet", df: pd.DataFrame | None = None):
+        df = pd.read_parquet(path) if df is None else df
         df = df.rename(columns={'Mã siêu thị':'store_id', 'Vĩ độ':'lat', 'Kinh độ':'lon'})
         df = df[['store_id','lat','lon']].dropna()
         self.df = df
+        self._ids = df['store_id'].to_numpy()
         self._lats = df['lat'].to_numpy()
         self._lons = df['lon'].to_numpy()
+        self._build_grid()
+
+    # region Grid index
+    def _build_grid(self):
+        n = len(self._lats)
+        self._lat0 = self._lats.min() if n else 0.0
+        self._lon0 = self._lons.min() if n else 0.0
+        rows = ((self._lats - self._lat0) // self.GRID_DEG).astype(np.int64)
+        cols = ((self._lons - self._lon0) // self.GRID_DEG).astype(np.int64)
+        self._nrows = int(rows.max()) + 1 if n else 0
+        self._ncols = int(cols.max()) + 1 if n else 0
+        keys = rows * self._ncols + cols
+        # cùng kiểu với _PartitionIndex: vị trí sắp theo ô + biên từng ô
+        self._order = np.argsort(keys, kind="stable")
+        self._cells, starts = np.unique(keys[self._order], return_index=True)
+        self._bounds = np.append(starts, n)
+
+    def _candidates(self, lat, lon, radius_km):
+        """
+        Vị trí (tăng dần) các siêu thị trong bounding box bán kính radius_km quanh (lat, lon).
+        None nếu box chạm cực / kinh tuyến 180 -> caller quét toàn bộ.
+        """
+        ang = radius_km / _R_EARTH_KM
+        dlat = np.degrees(ang)
+        coslat = np.cos(np.radians(lat))
+        if abs(lat) + dlat >= 90 or ang >= np.pi / 2 or np.sin(ang) >= coslat:
+            return None
+        dlon = np.degrees(np.arcsin(np.sin(ang) / coslat))
+        if abs(lon) + dlon >= 180:
+            return None
+        eps = 1e-9  # nới biên chút cho sai số làm tròn
+        r0 = max(int((lat - dlat - eps - self._lat0) // self.GRID_DEG), 0)
+        r1 = min(int((lat + dlat + eps - self._lat0) // self.GRID_DEG), self._nrows - 1)
+        c0 = max(int((lon - dlon - eps - self._lon0) // self.GRID_DEG), 0)
+        c1 = min(int((lon + dlon + eps - self._lon0) // self.GRID_DEG), self._ncols - 1)
+        if r0 > r1 or c0 > c1:
+            return np.empty(0, dtype=np.int64)
+        rows = np.arange(r0, r1 + 1) * self._ncols
+        lo = np.searchsorted(self._cells, rows + c0, side="left")
+        hi = np.searchsorted(self._cells, rows + c1, side="right")
+        parts = [self._order[self._bounds[a]:self._bounds[b]] for a, b in zip(lo, hi) if b > a]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+    # endregion
+
+    def _frame(self, idx, dist):
+        return pd.DataFrame({
+            'store_id': self._ids[idx],
+            'lat': self._lats[idx],
+            'lon': self._lons[idx],
+            'distance_km': dist,
+        })
 
-    def nearest(self, lat, lon, k=3, max_km=None):
+    def _nearest_scan(self, lat, lon, k=3, max_km=None):
+        """Quét toàn bộ (bản tham chiếu cho index lưới)."""
         d = _haversine_km(lat, lon, self._lats, self._lons)
-        k = min(k, len(d))
-        idx = np.argpartition(d, kth=k-1)[:k]
-        idx = idx[np.argsort(d[idx])]
-        out = self.df.iloc[idx].copy()
-        out['distance_km'] = d[idx]
+        idx = np.argsort(d, kind="stable")[:max(k, 0)]
         if max_km is not None:
-            out = out[out['distance_km'] <= max_km]
-        return out.reset_index(drop=True)
+            idx = idx[d[idx] <= max_km]
+        return self._frame(idx, d[idx])
 
-# lazy singleton
-_LOCATOR = None
+    def nearest(self, lat, lon, k=3, max_km=None):
+        """
+        k siêu thị gần (lat, lon) nhất (bỏ những siêu thị xa hơn max_km nếu có).
+        Returns:
+            DataFrame store_id, lat, lon, distance_km sắp theo khoảng cách tăng dần.
+        """
+        n = len(self._lats)
+        k = min(k, n)
+        if k <= 0:
+            return self._frame(np.empty(0, dtype=np.int64), np.empty(0))
+        if not (np.isfinite(lat) and np.isfinite(lon)):
+            return self._nearest_scan(lat, lon, k=k, max_km=max_km)
+        radius = max_km if max_km is not None else self.SEARCH_KM
+        while True:
+            cand = self._candidates(lat, lon, radius)
+            if cand is None:
+                return self._nearest_scan(lat, lon, k=k, max_km=max_km)
+            d = _haversine_km(lat, lon, self._lats[cand], self._lons[cand])
+            if max_km is not None:
+                # ngoài box chắc chắn > max_km -> top-k trong box là đáp án
+                keep = d <= max_km
+                cand, d = cand[keep], d[keep]
+                break
+            if (d <= radius).sum() >= k or len(cand) == n:
+                break  # đủ k siêu thị trong bán kính -> siêu thị ngoài box không thể gần hơn
+            radius *= 4
+        top = np.argsort(d, kind="stable")[:k]
+        return self._frame(cand[top], d[top])
+
+    def nearest_many(self, lats, lons, k=3, max_km=None):
+        """
+        nearest() cho nhiều điểm một lúc (phân tích, tính vùng phủ siêu thị...).
+        Tính ma trận khoảng cách theo lượt (BATCH_CELLS ô / lượt), kết quả mỗi điểm giống hệt nearest().
+        Returns:
+            DataFrame point (vị trí điểm trong input), store_id, lat, lon, distance_km,
+            sắp theo (point, khoảng cách).
+        """
+        lats = np.asarray(lats, dtype=float).ravel()
+        lons = np.asarray(lons, dtype=float).ravel()
+        n = len(self._lats)
+        k = min(k, n)
+        if k <= 0 or len(lats) == 0:
+            out = self._frame(np.empty(0, dtype=np.int64), np.empty(0))
+            out.insert(0, 'point', np.empty(0, dtype=np.int64))
+            return out
+        step = max(1, self.BATCH_CELLS // n)
+        points, idxs, dists = [], [], []
+        for s in range(0, len(lats), step):
+            d = _haversine_km(lats[s:s + step, None], lons[s:s + step, None], self._lats[None, :], self._lons[None, :])
+            top = np.argpartition(d, k - 1, axis=1)[:, :k]
+            td = np.take_along_axis(d, top, axis=1)
+            top = np.take_along_axis(top, np.lexsort((top, td), axis=1), axis=1)
+            # hoà khoảng cách ở biên k (hoặc NaN): argpartition chọn tuỳ ý -> sắp lại ổn định cả dòng
+            kth = td.max(axis=1)
+            redo = ((d <= kth[:, None]).sum(axis=1) > k) | np.isnan(kth)
+            if redo.any():
+                top[redo] = np.argsort(d[redo], axis=1, kind="stable")[:, :k]
+            td = np.take_along_axis(d, top, axis=1)
+            pt = np.broadcast_to(np.arange(s, s + len(d))[:, None], top.shape)
+            keep = td <= max_km if max_km is not None else np.ones(top.shape, dtype=bool)
+            points.append(pt[keep]); idxs.append(top[keep]); dists.append(td[keep])
+        out = self._frame(np.concatenate(idxs), np.concatenate(dists))
+        out.insert(0, 'point', np.concatenate(points))
+        return out
+
+# locator build 1 lần / version location.parquet qua cache -> reloader tự swap khi có file mới
+_LOCATION_PATH = "data/location.parquet"
 def init_store_locator(path="data/location.parquet"):
-    global _LOCATOR
-    _LOCATOR = StoreLocator(path)
+    global _LOCATION_PATH
+    _LOCATION_PATH = path
+    return get_store_locator()
+
+def get_store_locator() -> StoreLocator:
+    return load_derived(_LOCATION_PATH, "store_locator", lambda df: StoreLocator(df=df))
 
 def nearest_stores(lat, lon, k=3, max_km=30):
-    global _LOCATOR
-    if _LOCATOR is None:
-        try:
-            _LOCATOR = StoreLocator()  # mặc định đọc bhx_stores.parquet
-        except Exception:
-            return None
-    return _LOCATOR.nearest(lat, lon, k=k, max_km=max_km)
+    try:
+        locator = get_store_locator()
+    except Exception:
+        return None
+    return locator.nearest(lat, lon, k=k, max_km=max_km)
 # endregion
 
-def get_groups_for_category(data_path: str, cat_id: int):
-    df_nhucau = load_df_once(data_path)
-    df_nhucau = df_nhucau[df_nhucau['Mã ngành hàng'] == int(cat_id)]
-    subgroups = df_nhucau['Nhóm hàng'].dropna().astype(str).unique().tolist()
-    subgroups.sort()
-    subgroups.append("Xem tất cả nhóm")
-    return subgroups
+# region Catalog
+ALL_GROUPS = "Xem tất cả nhóm"
+
+class Catalog:
+    """
+    Danh mục dùng cho menu, build 1 lần / version dữ liệu nhu cầu (qua cache.load_derived):
+    tập mã siêu thị hợp lệ, tên siêu thị, danh sách nhóm hàng đã sắp theo ngành và theo (siêu thị, ngành).
+    Các bước menu chỉ còn tra dict / set, không lọc DataFrame trong request.
+    """
+    def __init__(self, df: pd.DataFrame):
+        names = df[["Mã siêu thị", "Tên siêu thị"]].drop_duplicates("Mã siêu thị")
+        self.store_names = {int(s): (str(n) if pd.notna(n) else "")
+                            for s, n in names.itertuples(index=False, name=None)}
+        self.stores = frozenset(self.store_names)
+
+        # mỗi (siêu thị, ngành, nhóm) 1 dòng -> gom nhóm theo ngành và theo (siêu thị, ngành)
+        trip = df[["Mã siêu thị", "Mã ngành hàng", "Nhóm hàng"]].dropna().drop_duplicates()
+        by_cat: dict[int, set] = {}
+        by_store_cat: dict[tuple[int, int], set] = {}
+        for store, cat, group in trip.itertuples(index=False, name=None):
+            group = str(group)
+            by_cat.setdefault(int(cat), set()).add(group)
+            by_store_cat.setdefault((int(store), int(cat)), set()).add(group)
+        self._by_cat = {k: tuple(sorted(v)) for k, v in by_cat.items()}
+        self._by_store_cat = {k: tuple(sorted(v)) for k, v in by_store_cat.items()}
+
+    def store_name(self, store_id) -> str:
+        return self.store_names.get(int(store_id), "")
+
+    def groups(self, cat_id, store_id=None) -> list[str]:
+        """
+        Nhóm hàng của ngành cat_id (đã sắp) + "Xem tất cả nhóm" ở cuối.
+        store_id: chỉ lấy các nhóm siêu thị đó có dữ liệu.
+        """
+        if store_id is None:
+            groups = self._by_cat.get(int(cat_id), ())
+        else:
+            groups = self._by_store_cat.get((int(store_id), int(cat_id)), ())
+        return [*groups, ALL_GROUPS]
+
+def get_catalog(data_path: str) -> Catalog:
+    return load_derived(data_path, "catalog", Catalog)
+
+def get_groups_for_category(data_path: str, cat_id: int, store_id: int | None = None):
+    return get_catalog(data_path).groups(cat_id, store_id=store_id)
+# endregion
@@ -0,0 +1,93 @@
+# warmup.py
+"""
+Nạp dữ liệu nền lúc boot (không block import app / boot worker gunicorn).
+- start(): chạy các bước warm-up ở thread nền (đọc parquet, build index...).
+- wait_ready(timeout): request cần dữ liệu chờ tới khi warm-up xong (tối đa timeout giây).
+- status(): tiến độ + thời gian từng bước + bộ nhớ dữ liệu cache cho /health.
+Chưa gọi start() (script, test) thì coi như ready: dữ liệu được nạp lười khi dùng tới.
+"""
+
+import os
+import time
+import threading
+
+from cache import load_df_once, memory_report
+from config import NHU_CAU_PATH, NHAP_BAN_PATH
+
+# request cần dữ liệu chờ warm-up tối đa bấy nhiêu giây rồi trả thông báo "đang khởi động"
+WARMUP_WAIT = float(os.getenv("WARMUP_WAIT", "20"))
+
+_READY = threading.Event()
+_STARTED = False
+_LOCK = threading.Lock()
+_BOOT_TS = time.time()
+# {step: {"state": pending|running|done|error, "seconds": float, "error": str}}
+_STEPS: dict[str, dict] = {}
+
+def _steps():
+    """Các bước warm-up theo thứ tự: đọc file trước, build index dùng trong request sau."""
+    # import trễ để tránh vòng import (handlers/report import warmup)
+    from report import _load_index
+    from utils import get_store_locator, get_catalog
+    return [
+        ("load:nhucau", lambda: load_df_once(NHU_CAU_PATH)),
+        ("load:nhapban", lambda: load_df_once(NHAP_BAN_PATH)),
+        ("index:catalog", lambda: get_catalog(NHU_CAU_PATH)),
+        ("index:nhucau", lambda: _load_index(NHU_CAU_PATH)),
+        ("index:nhapban", lambda: _load_index(NHAP_BAN_PATH)),
+        ("index:store_locator", get_store_locator),
+    ]
+
+def _run() -> None:
+    t0 = time.monotonic()
+    steps = _steps()
+    with _LOCK:
+        for name, _ in steps:
+            _STEPS[name] = {"state": "pending", "seconds": None}
+    for name, fn in steps:
+        st = _STEPS[name]
+        st["state"] = "running"
+        s0 = time.monotonic()
+        try:
+            fn()
+            st["state"] = "done"
+        except Exception as e:
+            # bước lỗi không chặn ready: request sẽ tự nạp lười (và báo lỗi) như trước
+            st["state"] = "error"
+            st["error"] = str(e)
+            print(f"[warmup][ERROR] {name}: {e}")
+        st["seconds"] = round(time.monotonic() - s0, 3)
+    _READY.set()
+    print(f"[warmup] ready sau {time.monotonic() - t0:.2f}s")
+
+def start() -> None:
+    """Bắt đầu warm-up nền (gọi 1 lần lúc boot app)."""
+    global _STARTED
+    with _LOCK:
+        if _STARTED:
+            return
+        _STARTED = True
+    threading.Thread(target=_run, name="warmup", daemon=True).start()
+    print("[warmup] started")
+
+def is_ready() -> bool:
+    return _READY.is_set() or not _STARTED
+
+def wait_ready(timeout: float = WARMUP_WAIT) -> bool:
+    """True khi dữ liệu đã sẵn sàng (hoặc warm-up không chạy), False nếu quá timeout."""
+    if not _STARTED:
+        return True
+    return _READY.wait(timeout)
+
+def status() -> dict:
+    with _LOCK:
+        steps = {k: dict(v) for k, v in _STEPS.items()}
+    done = sum(1 for s in steps.values() if s["state"] in ("done", "error"))
+    return {
+        "live": True,
+        "ready": is_ready(),
+        "uptime_s": round(time.time() - _BOOT_TS, 1),
+        "progress": f"{done}/{len(steps)}",
+        "steps": steps,
+        "memory": memory_report(),
+    }